@@ -9,7 +9,7 @@ fi
 
 if command -v apt &> /dev/null; then
     echo "Install dependancies (debian version)"
-    sudo apt install python3-pydub python3-pil python3-appdirs python3-pyqt5
+    sudo apt install python3-pydub python3-pil python3-numpy python3-appdirs python3-pyqt5
 fi
 
 if command -v kf5-config &> /dev/null; then
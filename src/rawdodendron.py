@@ -4,9 +4,9 @@
 import argparse
 from pydub import AudioSegment
 import sys
-from PIL import Image
+from PIL import Image, ImageFile, ImageSequence, PngImagePlugin
 import audioop
-from math import ceil, sqrt
+from math import ceil, sqrt, gcd, log
 import os
 from appdirs import *
 import pathlib
@@ -17,15 +17,70 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from copy import copy
 import re
+import numpy as np
+import wave
+import bisect
+import csv
+import contextlib
+import pydub.utils
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import mmap
+import io
+import signal
+import subprocess
+import threading
+import zlib
+import inspect
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where the PCM cache index is not locked
+    fcntl = None
+
+
+class ConversionError(Exception):
+    # raised by the conversion core and the library API, rather than exiting
+    pass
+
+
+class Cancelled(ConversionError):
+    # raised by the conversion core when the conversion has been cancelled (see Progress)
+    pass
 
 
 class Utils:
 
     def image_description(im):
-        return {"i_width": im.width, "i_mode": im.mode, "i_size": len(im.tobytes())}
+        return {"i_width": im.width, "i_mode": im.mode, "i_size": Utils.image_size(im)}
+
+    # number of bytes of the raw data of an image (as len(im.tobytes()), without encoding it)
+    def image_size(im):
+        return Utils.pixels_size(im.mode, im.width, im.height)
+
+    def pixels_size(mode, width, height):
+        if width == 0:
+            return 0
+        return len(Image.new(mode, (width, 1)).tobytes()) * height
+
+    # number of frames of an image (animated GIF, APNG or WebP, multi-page TIFF...)
+    def nb_frames(im):
+        return getattr(im, "n_frames", 1)
+
+    # name of the output of a frame (see --frames split): name-0001.ext
+    def frame_name(name, index):
+        if index == None:
+            return name
+        root, extension = os.path.splitext(name)
+        return root + "-{:04d}".format(index) + extension
+
+    def supports_frames(filename):
+        extension = os.path.splitext(filename)[1].lower()
+        return Image.registered_extensions().get(extension) in Image.SAVE_ALL
 
     def audio_description(au):
-        return {"a_bitrate": au.frame_rate, "a_channels": au.channels, "a_size": len(au.raw_data)}
+        # size of the 8-bits version of the audio
+        return {"a_bitrate": au.frame_rate, "a_channels": au.channels, "a_size": int(au.frame_count()) * au.channels}
 
     def description(obj):
         if isinstance(obj, Image.Image):
@@ -33,8 +88,91 @@ class Utils:
         else:
             return Utils.audio_description(obj)
 
+    def is_stdout(output):
+        return output is sys.stdout or getattr(output, "name", None) == "<stdout>"
+
+    def is_stdin(input):
+        return input is sys.stdin or getattr(input, "name", None) == "<stdin>"
+
+    def is_image_filename(filename):
+        # guess the kind of a file using its extension
+        extension = os.path.splitext(filename)[1].lower()
+        return extension in Image.registered_extensions()
+
+    def inverse_conversion_method(method):
+        inverses = {"linear": "linear",
+                    "u-law": "inverse u-law", "inverse u-law": "u-law",
+                    "a-law": "inverse a-law", "inverse a-law": "a-law"}
+        return inverses[method]
+
+    def set_conversion_method(args, method):
+        args.conversion_chain = None
+        args.conversion_linear = method == "linear"
+        args.conversion_u_law = method == "u-law"
+        args.conversion_inverse_u_law = method == "inverse u-law"
+        args.conversion_a_law = method == "a-law"
+        args.conversion_inverse_a_law = method == "inverse a-law"
+
+    # set the conversion of back_args to the inverse of the conversion of args
+    def set_inverse_conversion(back_args, args):
+        if args.conversion_chain != None:
+            inverse = ConversionChain.inverse(args.conversion_chain)
+            if inverse == None:
+                raise ConversionError("The conversion chain has no inverse")
+            Utils.set_conversion_method(back_args, "linear")
+            back_args.conversion_chain = inverse
+        else:
+            Utils.set_conversion_method(back_args, Utils.inverse_conversion_method(Utils.conversion_method(args)))
+
+    def parse_effect(spec, functions, kind):
+        # parse an effect description such as "echo:delay=250,decay=0.5", where the name is
+        # a key of functions. The parameters are checked against the arguments of the function
+        # that have a default value: numbers, unless the default value is a string
+        name, _, str_params = spec.partition(":")
+        name = name.strip()
+        if not name in functions:
+            raise ConversionError("Unknown " + kind + ": " + name + " (available: " + ", ".join(functions) + ")")
+        defaults = {k: p.default for k, p in inspect.signature(functions[name]).parameters.items() if p.default is not inspect.Parameter.empty}
+        params = {}
+        for p in str_params.split(","):
+            if p.strip() == "":
+                continue
+            key, sep, value = p.partition("=")
+            key = key.strip()
+            if sep == "":
+                raise ConversionError("Malformed parameter in " + spec + ": " + p)
+            if not key in defaults:
+                raise ConversionError("Unknown parameter of the " + kind + " " + name + ": " + key + " (parameters: " + ", ".join(defaults) + ")")
+            if isinstance(defaults[key], str):
+                params[key] = value.strip()
+            else:
+                try:
+                    params[key] = float(value)
+                except ValueError:
+                    raise ConversionError("The parameter " + key + " of the " + kind + " " + name + " must be a number: " + value.strip())
+        return name, params
+
+    # audio effects only apply when the output is audio (image to audio, or the audio step
+    # of a bent image), image filters only when the output is an image
+    def check_effects(args, from_image):
+        if from_image and args.image_filter:
+            raise ConversionError("Image filters are applied on the audio to image conversion, not on an image input: " + ", ".join(args.image_filter))
+        if not from_image and args.audio_effect:
+            raise ConversionError("Audio effects are applied on the image to audio conversion, not on an audio input: " + ", ".join(args.audio_effect))
+
+    # description of the conversion parameters, stored in history
+    def conversion_record(args):
+        record = {"conversion_method": Utils.conversion_method(args), "layout": args.layout if args.layout != None else "raster",
+                  "planar": args.planar if args.planar != None else "interleaved", "truncate": bool(args.truncate)}
+        if args.conversion_chain != None:
+            record["conversion_chain"] = args.conversion_chain
+            record["conversion_inverse"] = ConversionChain.inverse(args.conversion_chain)
+        return record
+
     def conversion_method(args):
-        if args.conversion_inverse_a_law:
+        if args.conversion_chain != None:
+            return "chain"
+        elif args.conversion_inverse_a_law:
             return "inverse a-law"
         elif args.conversion_a_law:
             return "a-law"
@@ -50,13 +188,48 @@ class Utils:
 class Parameters:
     # A class to manage parameters
 
+    # -o can be repeated: the first output is stored in args.output, the other ones
+    # in args.extra_outputs
+    class OutputAction(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string = None):
+            if getattr(namespace, "output", None) == None:
+                namespace.output = values
+            else:
+                namespace.extra_outputs = (namespace.extra_outputs or []) + [values]
+
+    # argparse type of --audio-effect and --image-filter: the description is checked
+    # when the command line is parsed, and kept as a string
+    def effect_type(functions, kind):
+        def check(spec):
+            try:
+                Utils.parse_effect(spec, functions, kind)
+            except ConversionError as err:
+                raise argparse.ArgumentTypeError(str(err))
+            return spec
+        return check
+
     def create_parser():
         parser = argparse.ArgumentParser(description="Audio/image converter using a raw approach. If no output options are given, the previous runs (history) are used to guess the possible parameters such as image size or bitrate.")
 
         group_command_line = parser.add_argument_group("Non interactive mode", "Use command line parameters to run conversion without graphical interface")
-        group_command_line.add_argument("-i", "--input", help="Input file", type=argparse.FileType('r'))
-        group_command_line.add_argument("-o", "--output", help="Requested longitude", type=argparse.FileType('w'))
+        group_command_line.add_argument("-i", "--input", help="Input file. Use - to read the standard input", type=argparse.FileType('r'))
+        group_command_line.add_argument("-o", "--output", help="Output file. Can be repeated to write several formats from a single conversion. Use - to write on the standard output", type=argparse.FileType('w'), action=Parameters.OutputAction)
+        parser.set_defaults(extra_outputs=None, progress=None, frame=None, produced=None, in_place=False)
+        group_command_line.add_argument("--input-format", help="Format of the standard input (-i -). raw is a stream of signed 8-bits samples, described by --bitrate and --mono/--stereo. Default: guessed from the data, except for raw", choices=Streams.formats, default=None)
+        group_command_line.add_argument("--output-format", help="Format of the standard output (-o -). raw is a stream of signed 8-bits samples", choices=Streams.formats, default=None)
         group_command_line.add_argument("--ignore-history", help="Ignore history and avoid parameter guessing", action="store_true")
+        group_command_line.add_argument("--batch", help="Convert each file, the output being written next to it with a free name (name.png, name (1).png...)", nargs="+", metavar="FILE", default=None)
+        group_command_line.add_argument("--batch-extension", help="Extension of the outputs of --batch (and of the manifest items without output). Default: png for audio files, wav for images", default=None)
+        group_command_line.add_argument("--manifest", help="Run the conversions described in a JSON or CSV manifest, with per-file parameters. The largest files are converted first, the completed items are saved in FILE.checkpoint to resume an interrupted run", metavar="FILE", default=None)
+        group_command_line.add_argument("--manifest-report", help="Report of the manifest run, with the duration of each item (JSON, or CSV if the extension is .csv). Default: FILE.report.json", metavar="REPORT", default=None)
+        group_command_line.add_argument("--jobs", help="Number of parallel conversions of a manifest. Default: number of processors", type=int, default=os.cpu_count())
+        group_command_line.add_argument("--probe", "--plan", help="Dry run: print the conversion plan of the given files (output size, duration, padding, history match) reading only their headers", nargs="+", metavar="FILE", default=None)
+        group_command_line.add_argument("--probe-format", help="Format of the conversion plan. Default: json", choices=Probe.formats, default="json")
+        group_command_line.add_argument("--decode-jobs", help="Number of ffmpeg processes decoding a long compressed audio file (mp3, ogg, flac...) by segments. Default: number of processors. Use 1 to decode with a single process", type=int, default=os.cpu_count())
+        group_command_line.add_argument("--png-compression", help="Compression of the PNG images converted from audio, deflated by blocks in parallel: auto (stored if the image is noise-like, level 6 otherwise, with filters if they help), stored (no compression), fast (level 1), best (level 9, with filters if they help) or pillow (PIL encoder, single threaded). Default: auto", choices=PNGWriter.compressions, default="auto")
+        group_command_line.add_argument("--png-jobs", help="Number of threads compressing a PNG image. Default: number of processors", type=int, default=os.cpu_count())
+        group_command_line.add_argument("--pcm-cache-size", help="Maximum size (in MB) of the cache of decoded compressed audio files (mp3, ogg, flac...). Default: 2048. Use 0 to disable the cache", type=int, default=PCMCache.max_size >> 20)
+        group_command_line.add_argument("--history-tolerance", help="Maximum size difference (in percent) between the input and a previous output to reuse its parameters. Default: 1.0. Use 0 for an exact match", type=float, default=1.0)
 
         group_conversion = group_command_line.add_mutually_exclusive_group(required=False)
         group_conversion.add_argument("--conversion-linear", help="Use a linear 8-bits conversion", action="store_true")
@@ -64,33 +237,56 @@ class Parameters:
         group_conversion.add_argument("--conversion-a-law", help="Use the a-law algorithm within an 8-bits conversion", action="store_true")
         group_conversion.add_argument("--conversion-inverse-u-law", help="Use the inverse u-law algorithm within an 8-bits conversion", action="store_true")
         group_conversion.add_argument("--conversion-inverse-a-law", help="Use the inverse a-law algorithm within an 8-bits conversion", action="store_true")
+        group_conversion.add_argument("--conversion-chain", help="Apply a sequence of byte conversions, composed in a single table. Steps: linear, u-law, inverse u-law, a-law, inverse a-law, bit-reverse, gamma:G (curve on the unsigned bytes), map:FILE (256 values between 0 and 255). The inverse chain is stored in history. Example: --conversion-chain u-law \"inverse a-law\" gamma:0.8", nargs="+", metavar="STEP", default=None)
+
+        group_command_line.add_argument("--frames", help="Conversion of the images with several frames (animated GIF, APNG or WebP, multi-page TIFF): first (only the first frame), concat (the frames are a single audio stream, and an audio file is converted to a multi-frame image of frames of --width * --frame-height pixels) or split (an output per frame: name-0001.ext...). Default: first, or concat if the file was produced by a concat conversion", choices=Options.frame_conversions, default=None)
+        group_command_line.add_argument("--layout", help="Order of the pixels in the image. Default: raster (row by row), or the layout found in history", choices=Layouts.names, default=None)
+        group_command_line.add_argument("--planar", help="Mapping between the audio and the color planes: interleaved (consecutive bytes are consecutive components), channels (each audio channel fills whole planes) or segments (contiguous parts of the stream fill the planes). Default: interleaved, or the mapping found in history", choices=Planar.names, default=None)
 
         group_extra_bytes = group_command_line.add_mutually_exclusive_group(required=False)
         group_extra_bytes.add_argument("-t", "--truncate", help="Truncate data rather than adding empty elements", action="store_true")
         group_extra_bytes.add_argument("-a", "--add-extra-bytes", help="Add empty elements to fill the structure when bytes are missing", action="store_true")
 
         group_img2aud = parser.add_argument_group("Image to audio options", "Adjust the image to audio conversion")
-        group_img2aud.add_argument("--bitrate", help="Bitrate (44.1 kHz or 48 kHz)", choices=[44100, 48000], default=None)
+        group_img2aud.add_argument("--bitrate", help="Bitrate (44.1 kHz or 48 kHz)", type=int, choices=[44100, 48000], default=None)
         group_channels = group_img2aud.add_mutually_exclusive_group(required=False)
         group_channels.add_argument("--mono", help="Generate a mono file. Default: stereo", action="store_true")
         group_channels.add_argument("--stereo", help="Generate a stereo file. Default: stereo", action="store_true")
+        group_img2aud.add_argument("--audio-effect", help="Apply an audio effect on the samples, before writing the audio file (or the bent image if the output is an image). Can be repeated. Syntax: name:key=value,key=value. Effects: " + ", ".join(AudioEffects.effects) + ". Example: --audio-effect echo:delay=250,decay=0.5", action="append", type=Parameters.effect_type(AudioEffects.effects, "audio effect"), default=None)
 
         group_aud2img = parser.add_argument_group("Audio to image options", "Adjust the audio to image conversion")
         group_size = group_aud2img.add_mutually_exclusive_group(required=False)
         group_size.add_argument("-r", "--ratio", help="Ratio", type=float, default=None)
         group_size.add_argument("-w", "--width", help="Number of pixels (width)", type=int, default=None)
+        group_size.add_argument("--auto-width", help="Choose a width that matches a dominant periodicity of the audio", action="store_true")
+        group_aud2img.add_argument("--exact-fit", help="Choose the size that fills the image without missing nor truncated bytes, the nearest to the ratio (default: 1). Ignored with --width", action="store_true")
 
         group_pixels = group_aud2img.add_mutually_exclusive_group(required=False)
         group_pixels.add_argument("--rgb", help="Generate RGB image. Default: RGB", action="store_true")
         group_pixels.add_argument("--greyscale", help="Generate greyscale image. Default: RGB", action="store_true")
         group_pixels.add_argument("--rgba", help="Generate RGBA image. Default: RGB", action="store_true")
+        group_aud2img.add_argument("--image-filter", help="Apply an image filter on the pixels, before writing the image file (or the bent audio file if the output is an audio file). Can be repeated. Syntax: name:key=value,key=value. Filters: " + ", ".join(ImageFilters.filters) + ". Example: --image-filter blur:radius=3", action="append", type=Parameters.effect_type(ImageFilters.filters, "image filter"), default=None)
+
+        group_video = parser.add_argument_group("Audio to video options", "Convert an audio file to a video, each frame being a moving window over the audio stream. Frame size is given by --width and --frame-height, or computed from --frame-duration using the size options")
+        group_video.add_argument("--video", help="Generate a video (y4m or raw frames). Default: y4m if the output extension is .y4m", nargs="?", const="y4m", choices=Video.formats, default=None)
+        group_video.add_argument("--frame-duration", help="Duration of the audio shown in a frame (ms). Default: 1000", type=float, default=1000)
+        group_video.add_argument("--frame-height", help="Number of pixels (height) of a frame", type=int, default=None)
+        group_video.add_argument("--hop", help="Duration between two successive frames (ms). Default: frame duration (no overlap)", type=float, default=None)
 
         parser.add_argument("-v", "--verbose", help="Verbose messages", action="store_true")
 
         return parser
 
+    # default values of the command line parameters
+    default_values = None
+
+    def default_args():
+        if Parameters.default_values == None:
+            Parameters.default_values = Parameters.create_parser().parse_args([])
+        return copy(Parameters.default_values)
+
     def has_image_size_parameter(args):
-        return args.width != None or args.ratio != None
+        return args.width != None or args.ratio != None or args.auto_width or args.exact_fit
 
     def has_image_mode_parameter(args):
         return args.rgb or args.rgba or args.greyscale
@@ -102,7 +298,7 @@ class Parameters:
         return args.truncate or args.add_extra_bytes
 
     def has_conversion_method(args):
-        return args.conversion_a_law or args.conversion_inverse_a_law or args.conversion_u_law or args.conversion_inverse_u_law or args.conversion_linear
+        return args.conversion_a_law or args.conversion_inverse_a_law or args.conversion_u_law or args.conversion_inverse_u_law or args.conversion_linear or args.conversion_chain != None
 
 
 
@@ -119,9 +315,16 @@ class History:
     # 
     # ```rawdodendron.py -i image.png -o audio.wav``` to convert an image to an audio file
     # ```rawdodendron.py -i audio.wav -o image.png``` to convert an audio file to an image
+    #
+    # Edited files (a tail added by a DAW, a cropped image) do not have the exact size of the
+    # produced file, thus the nearest sizes are also considered, within a tolerance.
     history_dir = user_data_dir("rawdodendron")
     history_file = pathlib.Path(history_dir).joinpath("history.json")
 
+    # loaded history, with the sorted list of its sizes, while the file is not modified
+    cache = None
+    cache_stamp = None
+
     def __init__(self):
         self.create_history_dir()    
 
@@ -142,8 +345,35 @@ class History:
             return {}
 
     def store_history(self, history):
-        with open(self.history_file, 'w') as outfile:
+        # written in a temporary file then renamed, so that another process (e.g. the
+        # workers of a manifest) never reads an incomplete history
+        tmp = str(self.history_file) + "." + str(os.getpid())
+        with open(tmp, 'w') as outfile:
             json.dump(history, outfile)
+        os.replace(tmp, self.history_file)
+        History.cache = None
+
+    # history and sorted sizes (as int), loaded again only if the file changed
+    def load_index(self):
+        try:
+            stat = os.stat(self.history_file)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except:
+            stamp = None
+        if History.cache == None or History.cache_stamp != stamp:
+            history = self.load_history()
+            History.cache = (history, sorted(int(k) for k in history))
+            History.cache_stamp = stamp
+        return History.cache
+
+    # entries with a size in [min_size, max_size]
+    def entries_in_range(self, min_size, max_size):
+        history, sizes = self.load_index()
+        first = bisect.bisect_left(sizes, min_size)
+        last = bisect.bisect_right(sizes, max_size)
+        for size in sizes[first:last]:
+            for entry in history[str(size)]:
+                yield size, entry
 
 
     def description_matches(full, subpart):
@@ -152,19 +382,36 @@ class History:
                 return False
         return True
 
-    def get_params_from_history(self, size, desc, from_image):
-        history = self.load_history()
-        str_size = str(size)
-        if str_size in history:
-            possible = [h for h in history[str_size] if h["from_image"] != from_image and History.description_matches(h, desc)]
-            if len(possible) == 0:
-                return None
-            # get the most recent
+    def get_params_from_history(self, size, desc, from_image, tolerance = 0.0):
+        # tolerance is a percentage of the size
+        delta = int(size * tolerance / 100)
+        size_keys = ["i_size", "a_size"]
+        desc = {k: desc[k] for k in desc if not k in size_keys}
+
+        possible = [(abs(s - size), e) for s, e in self.entries_in_range(size - delta, size + delta)
+                    if e["from_image"] != from_image and History.description_matches(e, desc)]
+        if len(possible) == 0:
+            return None
+
+        # get the nearest, then the most recent
+        distance, best = min(possible, key=lambda k: (k[0], -k[1]["timestamp"]))
+        confidence = 1.0 if distance == 0 else 1.0 - distance / (delta + 1)
+        if distance == 0:
             print("Found a probable output configuration from history")
-            sorted_possible = sorted(possible, key=lambda k: k["timestamp"], reverse=True) 
-            return sorted_possible[0]
         else:
-            return None
+            print("Found a probable output configuration from history (size difference: {} bytes, confidence: {:.0f}%)".format(distance, 100 * confidence))
+        result = dict(best)
+        result["confidence"] = confidence
+        return result
+
+    # parameters of the conversion that produced obj: embedded in the file if available,
+    # otherwise guessed from history
+    def get_params(self, obj, size, desc, from_image, args):
+        data = Metadata.record(obj)
+        if data != None and data["from_image"] != from_image:
+            print("Found the conversion parameters in the file metadata")
+            return data
+        return self.get_params_from_history(size, desc, from_image, args.history_tolerance)
 
     def store_params_to_history(self, data):
         # add current timestamp
@@ -203,6 +450,12 @@ class History:
                 args.conversion_inverse_u_law = False
                 args.conversion_a_law = False
                 args.conversion_inverse_a_law = False
+            elif "conversion_chain" in data:
+                # inverse previous conversion chain, if possible
+                Utils.set_conversion_method(args, "linear")
+                args.conversion_chain = data.get("conversion_inverse")
+                if args.conversion_chain == None:
+                    print("The previous conversion chain has no inverse, using a linear conversion")
             else:
                 # inverse previous conversion
                 args.conversion_linear = data["conversion_method"] == "linear"
@@ -211,10 +464,27 @@ class History:
                 args.conversion_a_law = data["conversion_method"] == "inverse a-law"
                 args.conversion_inverse_a_law = data["conversion_method"] == "a-law"
 
+    def consolidate_layout(args, data):
+        if args.layout == None:
+            if data == None or args.ignore_history:
+                args.layout = "raster"
+            else:
+                # use the same layout to get back the initial data
+                args.layout = data.get("layout", "raster")
+
+    def consolidate_planar(args, data):
+        if args.planar == None:
+            if data == None or args.ignore_history:
+                args.planar = "interleaved"
+            else:
+                args.planar = data.get("planar", "interleaved")
+
     def consolidate_parameters_from_image(self, args, im):
         # consolidate args
 
-        data = self.get_params_from_history(len(im.tobytes()), Utils.image_description(im), True)
+        # im can be None if only the raw data are known
+        size = None if im == None else Utils.image_size(im) * (Utils.nb_frames(im) if args.frames == "concat" else 1)
+        data = None if im == None or args.ignore_history else self.get_params(im, size, Utils.image_description(im), True, args)
 
         if data != None and not args.ignore_history:
             # try to consolidate using history
@@ -232,11 +502,19 @@ class History:
         
         History.consolidate_extra_bytes_method(args, data)
         History.consolidate_conversion_method(args, data)
+        History.consolidate_layout(args, data)
+        History.consolidate_planar(args, data)
+        History.consolidate_frames(args, data)
+        # (the frames of --frames split are converted one at a time, as the first one)
+        if im != None and args.frames == "first" and args.frame == None and Utils.nb_frames(im) > 1:
+            print("Only the first of the", Utils.nb_frames(im), "frames is converted (see --frames)")
+        return data
 
 
     def consolidate_parameters_from_audio(self, args, au):
         # consolidate args
-        data = self.get_params_from_history(len(au.raw_data), Utils.audio_description(au), False)
+        # au can be None if only the raw data are known
+        data = None if au == None or args.ignore_history else self.get_params(au, Utils.audio_description(au)["a_size"], Utils.audio_description(au), False, args)
         if data != None and not args.ignore_history:
             # try to consolidate using history
             if not Parameters.has_image_size_parameter(args) and "i_width" in data:
@@ -247,37 +525,2434 @@ class History:
                 args.greyscale = data["i_mode"] == "L"
 
         # set default values
-        if not Parameters.has_image_size_parameter(args):
-            args.ratio = 1.0 # default ratio value
         if not Parameters.has_image_mode_parameter(args):
             args.rgb = True
+        if args.auto_width and au != None:
+            Periodicity.set_auto_width(args, au)
+        elif args.exact_fit and args.width == None and au != None:
+            ExactFit.set_width(args, au)
+        if args.width == None and args.ratio == None:
+            args.ratio = 1.0 # default ratio value
 
         History.consolidate_extra_bytes_method(args, data)
         History.consolidate_conversion_method(args, data)
+        History.consolidate_layout(args, data)
+        History.consolidate_planar(args, data)
+        History.consolidate_frames(args, data)
+        return data
 
-    def store_parameters(self, au, im, from_image, conversion_method):
-        # store configuration
-        new_data = {"from_image": from_image, "conversion_method": conversion_method }
+    # a concat conversion of frames is reversed as a concat conversion, with the same frames
+    def consolidate_frames(args, data):
+        if args.frames != None:
+            return
+        if data != None and data.get("i_frames", 1) > 1:
+            args.frames = "concat"
+            if args.frame_height == None and args.width == data["i_width"]:
+                args.frame_height = data["i_size"] // data["i_frames"] // Utils.pixels_size(data["i_mode"], data["i_width"], 1)
+        else:
+            args.frames = "first"
+
+    # description of a conversion, as stored in history and in the file metadata.
+    # im is the first frame if several frames are concatenated
+    def record(au, im, from_image, args, frames = 1):
+        new_data = {"from_image": from_image }
+        new_data.update(Utils.conversion_record(args))
         new_data.update(Utils.image_description(im))
         new_data.update(Utils.audio_description(au))
-        self.store_params_to_history(new_data)
+        if frames > 1:
+            new_data["i_frames"] = frames
+            new_data["i_size"] *= frames
+        return new_data
+
+    def store_parameters(self, au, im, from_image, args):
+        # store configuration
+        self.store_params_to_history(History.record(au, im, from_image, args))
+
+
+class OutputNames:
+    # Allocate the names of the generated files: "name.ext", then "name (1).ext",
+    # "name (2).ext"... if the file already exists.
+    #
+    # Each directory is listed once, and the next free number is kept for each name, thus
+    # a batch does not probe the filesystem for each candidate. Names are reserved using an
+    # exclusive creation, so that parallel runs cannot choose the same file. A proposed
+    # name is free until it is reserved: proposing it again gives the same name.
+
+    def __init__(self):
+        # existing or reserved names, per directory
+        self.directories = {}
+        # next number to try, per (directory, stem, extension)
+        self.counters = {}
+
+    # forget the listed directories, e.g. when files may have been created or removed
+    # since the last allocation
+    def refresh(self):
+        self.directories = {}
+        self.counters = {}
+
+    def names(self, directory):
+        if not directory in self.directories:
+            try:
+                self.directories[directory] = set(os.listdir(directory))
+            except OSError:
+                self.directories[directory] = set()
+        return self.directories[directory]
+
+    # a free name (not reserved)
+    def propose(self, input_name, extension):
+        path = pathlib.Path(input_name)
+        directory = str(path.parent)
+        stem = str(path.stem)
+        # start from the number of the input name, if any
+        i = 0
+        m = re.search(r'(.*) \(([0-9]+?)\)$', stem)
+        if m:
+            stem = m.group(1)
+            i = int(m.group(2))
+        key = (directory, stem, extension)
+        i = max(i, self.counters.get(key, 0))
+
+        names = self.names(directory)
+        while True:
+            name = stem + extension if i == 0 else stem + " (" + str(i) + ")" + extension
+            if not name in names:
+                break
+            i += 1
+        self.counters[key] = i
+        return directory + "/" + name
+
+    # create the file if it does not exist. Returns the file object, or None
+    def reserve(self, filename):
+        path = pathlib.Path(filename)
+        try:
+            f = open(filename, "x")
+        except FileExistsError:
+            # created since the directory was listed
+            self.names(str(path.parent)).add(path.name)
+            return None
+        self.names(str(path.parent)).add(path.name)
+        return f
+
+    # a free name, created on disk. Returns the file object
+    def allocate(self, input_name, extension):
+        while True:
+            f = self.reserve(self.propose(input_name, extension))
+            if f != None:
+                return f
+
+
+class Metadata:
+    # Embed the conversion record (the entry stored in history) in the generated files, to
+    # get back the initial data without history (e.g. on another computer).
+    #
+    # The record is stored as JSON in a PNG text chunk, a TIFF image description, a JPEG or
+    # GIF comment, a WAV LIST/INFO comment chunk, or a comment tag for the formats encoded
+    # by ffmpeg (Vorbis comments, ID3...).
+    key = "rawdodendron"
+    prefix = key + ":"
+
+    def encode(record):
+        return json.dumps(record, separators=(",", ":"))
+
+    def decode(text):
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "replace")
+        if text.startswith(Metadata.prefix):
+            text = text[len(Metadata.prefix):]
+        try:
+            record = json.loads(text)
+            return record if isinstance(record, dict) and "from_image" in record else None
+        except ValueError:
+            return None
+
+    # record attached to a loaded image or audio file
+    def record(obj):
+        if isinstance(obj, Image.Image):
+            for text in [obj.info.get(Metadata.key), obj.info.get("comment"),
+                         getattr(obj, "tag_v2", {}).get(270)]:
+                if text != None and Metadata.decode(text) != None:
+                    return Metadata.decode(text)
+            return None
+        return getattr(obj, "conversion_record", None)
+
+    # parameters of Image.save
+    def image_parameters(record):
+        if record == None:
+            return {}
+        info = PngImagePlugin.PngInfo()
+        info.add_itxt(Metadata.key, Metadata.encode(record))
+        text = Metadata.prefix + Metadata.encode(record)
+        return {"pnginfo": info, "description": text, "comment": text}
+
+    # parameters of AudioSegment.export (formats encoded by ffmpeg)
+    def audio_parameters(record, format):
+        if record == None or format in ["wav", "raw"]:
+            return {}
+        return {"tags": {"comment": Metadata.prefix + Metadata.encode(record)}}
+
+    # add a LIST/INFO chunk with a comment (ICMT) at the end of a wav file
+    def append_wav_chunk(f, record):
+        text = (Metadata.prefix + Metadata.encode(record)).encode("utf-8") + b"\0"
+        if len(text) % 2 != 0:
+            text += b"\0"
+        chunk = b"INFO" + b"ICMT" + len(text).to_bytes(4, "little") + text
+        f.seek(0, os.SEEK_END)
+        f.write(b"LIST" + len(chunk).to_bytes(4, "little") + chunk)
+        riff_size = f.tell() - 8
+        f.seek(4)
+        f.write(riff_size.to_bytes(4, "little"))
+        f.seek(0)
+
+    # read the comment of a wav file, skipping the other chunks
+    def read_wav(f):
+        if f.read(4) != b"RIFF":
+            return None
+        f.seek(4, os.SEEK_CUR)
+        if f.read(4) != b"WAVE":
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size = int.from_bytes(header[4:], "little")
+            if header[:4] == b"LIST":
+                chunk = f.read(size)
+                if chunk[:4] == b"INFO":
+                    pos = 4
+                    while pos + 8 <= len(chunk):
+                        sub_size = int.from_bytes(chunk[pos + 4:pos + 8], "little")
+                        if chunk[pos:pos + 4] == b"ICMT":
+                            return Metadata.decode(chunk[pos + 8:pos + 8 + sub_size].rstrip(b"\0"))
+                        pos += 8 + sub_size + sub_size % 2
+                if size % 2 != 0:
+                    f.seek(1, os.SEEK_CUR)
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+    def read_audio(filename):
+        try:
+            if hasattr(filename, "seek"):
+                filename.seek(0)
+                record = Metadata.read_wav(filename)
+                filename.seek(0)
+                return record
+            with open(filename, "rb") as f:
+                record = Metadata.read_wav(f)
+            if record == None and not filename.lower().endswith(".wav"):
+                record = Metadata.read_tags(pydub.utils.mediainfo(filename).get("TAG", {}))
+            return record
+        except Exception:
+            return None
+
+    # record stored in the comment tag of an audio file, the tags being given by ffprobe
+    def read_tags(tags):
+        for key in tags:
+            if key.lower() == "comment":
+                return Metadata.decode(tags[key])
+        return None
+
+
+class AudioEffects:
+    # A class that applies audio effects on the 8-bits samples produced by save_as_audio,
+    # without going through a Digital Audio Workstation.
+    #
+    # Each effect is described by a string such as "echo:delay=250,decay=0.5". Durations
+    # are given in ms, frequencies in Hz and levels in dB. All the effects are vectorized
+    # numpy operations over a (frames, channels) float32 array.
+
+    # number of frames processed by each FFT in the block convolution
+    block_size = 1 << 16
+
+    def apply(data, channels, frame_rate, effects, verbose = False):
+        if not effects:
+            return data
+
+        # 8-bits samples are signed in AudioSegment
+        samples = np.frombuffer(data, dtype=np.int8).reshape(-1, channels).astype(np.float32)
+
+        for spec in effects:
+            name, params = Utils.parse_effect(spec, AudioEffects.effects, "audio effect")
+            if verbose:
+                print("Apply audio effect:", spec)
+            try:
+                samples = AudioEffects.effects[name](samples, frame_rate, **params)
+            except TypeError as err:
+                raise ConversionError("Wrong parameters for audio effect " + name + ": " + str(err))
+
+        return np.clip(np.rint(samples), -128, 127).astype(np.int8).tobytes()
+
+    def frames(ms, frame_rate):
+        return max(1, int(round(ms * frame_rate / 1000)))
+
+    def convolve(x, ir, delay = 0):
+        # FFT convolution of a 1D signal using overlap-add. All the blocks of a group
+        # are transformed in a single batched FFT. The output has the length of the input,
+        # starting after the given delay.
+        n = len(x)
+        length = len(ir)
+        block = max(AudioEffects.block_size, length)
+        fft_size = 1 << int(ceil(np.log2(block + length - 1)))
+        spectrum = np.fft.rfft(ir.astype(np.float32), fft_size)
+
+        nb_blocks = ceil((n + delay) / block)
+        padded = np.zeros(nb_blocks * block, dtype=np.float32)
+        padded[:n] = x
+        out = np.zeros((nb_blocks + 1) * block, dtype=np.float32)
+
+        # process ~64 MB of spectrum at a time
+        group = max(1, (1 << 23) // fft_size)
+        for first in range(0, nb_blocks, group):
+            last = min(nb_blocks, first + group)
+            segments = padded[first * block:last * block].reshape(-1, block)
+            y = np.fft.irfft(np.fft.rfft(segments, fft_size, axis=1) * spectrum, fft_size, axis=1)
+            start = first * block
+            end = last * block
+            out[start:end] += y[:, :block].reshape(-1)
+            out[start + block:end + block].reshape(-1, block)[:, :length - 1] += y[:, block:block + length - 1]
+
+        return out[delay:delay + n]
+
+    def lowpass_kernel(cutoff, frame_rate, taps):
+        # windowed-sinc FIR filter
+        taps = int(taps) | 1
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = np.sinc(2 * cutoff / frame_rate * n) * np.blackman(taps)
+        return kernel / np.sum(kernel)
+
+    def fir(samples, kernel):
+        delay = (len(kernel) - 1) // 2
+        for c in range(samples.shape[1]):
+            samples[:, c] = AudioEffects.convolve(samples[:, c], kernel, delay)
+        return samples
+
+    def lowpass(samples, frame_rate, freq = 1000, taps = 255):
+        return AudioEffects.fir(samples, AudioEffects.lowpass_kernel(freq, frame_rate, taps))
+
+    def highpass(samples, frame_rate, freq = 1000, taps = 255):
+        kernel = -AudioEffects.lowpass_kernel(freq, frame_rate, taps)
+        kernel[len(kernel) // 2] += 1
+        return AudioEffects.fir(samples, kernel)
+
+    def bandpass(samples, frame_rate, low = 500, high = 2000, taps = 255):
+        kernel = AudioEffects.lowpass_kernel(high, frame_rate, taps) - AudioEffects.lowpass_kernel(low, frame_rate, taps)
+        return AudioEffects.fir(samples, kernel)
+
+    def eq(samples, frame_rate, freq = 1000, width = 500, gain = 6, taps = 255):
+        # boost (or cut) a frequency band: x + (g - 1) * bandpass(x)
+        band = AudioEffects.lowpass_kernel(freq + width / 2, frame_rate, taps) - AudioEffects.lowpass_kernel(max(freq - width / 2, 0), frame_rate, taps)
+        kernel = (10 ** (gain / 20) - 1) * band
+        kernel[len(kernel) // 2] += 1
+        return AudioEffects.fir(samples, kernel)
+
+    def reverb(samples, frame_rate, duration = 1000, mix = 0.3, seed = 0):
+        # convolution with a synthetic impulse response (decorrelated noise per channel,
+        # with an exponential decay of 60 dB over the given duration)
+        length = AudioEffects.frames(duration, frame_rate)
+        rng = np.random.default_rng(int(seed))
+        envelope = np.exp(-6.9 * np.arange(length, dtype=np.float32) / length)
+        for c in range(samples.shape[1]):
+            ir = rng.standard_normal(length).astype(np.float32) * envelope
+            ir /= np.sqrt(np.sum(ir ** 2))
+            wet = AudioEffects.convolve(samples[:, c], ir)
+            samples[:, c] = (1 - mix) * samples[:, c] + mix * wet
+        return samples
+
+    def echo(samples, frame_rate, delay = 250, decay = 0.5):
+        # feedback delay line: y[n] = x[n] + decay * y[n - delay],
+        # computed one delay-long block at a time
+        d = AudioEffects.frames(delay, frame_rate)
+        for start in range(d, len(samples), d):
+            end = min(start + d, len(samples))
+            samples[start:end] += decay * samples[start - d:end - d]
+        return samples
+
+    def compress(samples, frame_rate, threshold = -20, ratio = 4, window = 10, makeup = 0):
+        # the RMS level is estimated on blocks of the given duration, the gain is
+        # computed per block then linearly interpolated on each frame
+        w = AudioEffects.frames(window, frame_rate)
+        n = len(samples)
+        nb_blocks = ceil(n / w)
+        power = np.zeros(nb_blocks * w, dtype=np.float32)
+        power[:n] = np.mean(samples ** 2, axis=1)
+        rms = np.sqrt(np.mean(power.reshape(-1, w), axis=1))
+        level = 20 * np.log10(np.maximum(rms, 1e-6) / 128)
+        over = np.maximum(level - threshold, 0)
+        gain_db = makeup - over * (1 - 1 / ratio)
+        gain = (10 ** (gain_db / 20)).astype(np.float32)
+        centers = np.arange(nb_blocks) * w + w / 2
+        for start in range(0, n, AudioEffects.block_size * 16):
+            end = min(n, start + AudioEffects.block_size * 16)
+            g = np.interp(np.arange(start, end), centers, gain).astype(np.float32)
+            samples[start:end] *= g[:, np.newaxis]
+        return samples
+
+    def resample(samples, frame_rate, rate = None, factor = None):
+        # linear interpolation; the output is played at the initial frame rate, thus
+        # resampling changes both length and pitch
+        if factor == None:
+            factor = (rate if rate != None else frame_rate) / frame_rate
+        n = len(samples)
+        new_n = max(1, int(round(n * factor)))
+        result = np.empty((new_n, samples.shape[1]), dtype=np.float32)
+        for start in range(0, new_n, AudioEffects.block_size * 16):
+            end = min(new_n, start + AudioEffects.block_size * 16)
+            positions = np.minimum(np.arange(start, end) / factor, n - 1)
+            before = positions.astype(np.int64)
+            after = np.minimum(before + 1, n - 1)
+            weight = (positions - before).astype(np.float32)[:, np.newaxis]
+            result[start:end] = samples[before] * (1 - weight) + samples[after] * weight
+        return result
+
+    def gain(samples, frame_rate, db = 6):
+        samples *= 10 ** (db / 20)
+        return samples
+
+    effects = { "reverb": reverb, "echo": echo, "compress": compress,
+                "lowpass": lowpass, "highpass": highpass, "bandpass": bandpass, "eq": eq,
+                "resample": resample, "gain": gain }
+
+
+class ImageFilters:
+    # A class that applies image filters on the 2D layout computed by save_as_image,
+    # without going through a Raster Graphic Editor.
+    #
+    # Each filter is described by a string such as "blur:radius=3", using the same syntax
+    # as the audio effects. All the filters are vectorized numpy operations over a
+    # (height, width, channels) array.
+
+    # number of rows processed at a time by the median filter
+    median_rows = 64
+
+    def apply(data, width, height, channels, filters, verbose = False):
+        if not filters:
+            return data, width, height
+
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+        pixels, mask = ImageFilters.apply_pixels(pixels, filters, verbose)
+
+        return np.ascontiguousarray(pixels).tobytes(), pixels.shape[1], pixels.shape[0]
+
+    # apply the filters on a (height, width, channels) array. If a mask (an array of the
+    # same shape) is given, it is moved by the filters that move the pixels, e.g. to follow
+    # the bytes added to fill the image
+    def apply_pixels(pixels, filters, verbose = False, mask = None):
+        for spec in filters:
+            name, params = Utils.parse_effect(spec, ImageFilters.filters, "image filter")
+            if verbose:
+                print("Apply image filter:", spec)
+            try:
+                if mask is not None and name in ImageFilters.moving_filters:
+                    mask = ImageFilters.move_mask(name, params, pixels, mask)
+                pixels = ImageFilters.filters[name](pixels, **params)
+            except TypeError as err:
+                raise ConversionError("Wrong parameters for image filter " + name + ": " + str(err))
+            if pixels.dtype != np.uint8:
+                pixels = np.clip(np.rint(pixels), 0, 255).astype(np.uint8)
+
+        return pixels, mask
+
+    # the mask moved as the pixels by the filter (pixels are the filter input)
+    def move_mask(name, params, pixels, mask):
+        if name == "pixelsort":
+            return np.take_along_axis(mask, ImageFilters.pixelsort_order(pixels, **params)[:, :, np.newaxis], axis=1)
+        return ImageFilters.filters[name](mask, **params)
+
+    def box(pixels, radius, axis):
+        # moving average along one axis, using a cumulative sum on an edge-padded array
+        radius = int(radius)
+        a = np.moveaxis(pixels.astype(np.float32), axis, 0)
+        n = a.shape[0]
+        padded = np.pad(a, [(radius + 1, radius)] + [(0, 0)] * (a.ndim - 1), mode="edge")
+        padded[0] = 0
+        c = np.cumsum(padded, axis=0)
+        result = (c[2 * radius + 1:2 * radius + 1 + n] - c[:n]) / (2 * radius + 1)
+        return np.moveaxis(result, 0, axis)
+
+    # the values of the parameters are checked by each filter, before numpy gets them
+    def check(name, valid, message):
+        if not valid:
+            raise ConversionError("Wrong parameters for image filter " + name + ": " + message)
+
+    def blur(pixels, radius = 2):
+        ImageFilters.check("blur", radius >= 0, "the radius must be positive or zero")
+        return ImageFilters.box(ImageFilters.box(pixels, radius, 0), radius, 1)
+
+    def sharpen(pixels, radius = 1, amount = 1):
+        # unsharp mask
+        ImageFilters.check("sharpen", radius >= 0, "the radius must be positive or zero")
+        p = pixels.astype(np.float32)
+        return p + amount * (p - ImageFilters.blur(p, radius))
+
+    def median(pixels, radius = 1):
+        ImageFilters.check("median", radius >= 0, "the radius must be positive or zero")
+        radius = int(radius)
+        size = 2 * radius + 1
+        padded = np.pad(pixels, [(radius, radius), (radius, radius), (0, 0)], mode="edge")
+        windows = np.lib.stride_tricks.sliding_window_view(padded, (size, size), axis=(0, 1))
+        result = np.empty_like(pixels)
+        for start in range(0, pixels.shape[0], ImageFilters.median_rows):
+            end = min(pixels.shape[0], start + ImageFilters.median_rows)
+            result[start:end] = np.median(windows[start:end], axis=(-2, -1))
+        return result
+
+    def edge(pixels, scale = 1):
+        # magnitude of the Sobel gradient
+        ImageFilters.check("edge", scale >= 0, "the scale must be positive or zero")
+        p = np.pad(pixels.astype(np.float32), [(1, 1), (1, 1), (0, 0)], mode="edge")
+        gx = (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])
+        gy = (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])
+        return scale * np.hypot(gx, gy)
+
+    def rotate(pixels, angle = 90):
+        # counterclockwise rotation, by a multiple of 90 degrees
+        ImageFilters.check("rotate", angle % 90 == 0, "the angle must be a multiple of 90 degrees")
+        return np.rot90(pixels, int(angle) // 90)
+
+    def transpose(pixels):
+        return pixels.transpose(1, 0, 2)
+
+    def flip(pixels, direction = "h"):
+        if direction == "h":
+            return pixels[:, ::-1]
+        elif direction == "v":
+            return pixels[::-1]
+        else:
+            raise ConversionError("Wrong parameters for image filter flip: the direction must be h or v")
+
+    def pixelsort_order(pixels, reverse = 0):
+        # order of the pixels of each row by brightness
+        key = np.sum(pixels, axis=2, dtype=np.uint16)
+        order = np.argsort(key, axis=1, kind="stable")
+        if reverse:
+            order = order[:, ::-1]
+        return order
+
+    def pixelsort(pixels, reverse = 0):
+        return np.take_along_axis(pixels, ImageFilters.pixelsort_order(pixels, reverse)[:, :, np.newaxis], axis=1)
+
+    filters = { "blur": blur, "sharpen": sharpen, "median": median, "edge": edge,
+                "rotate": rotate, "transpose": transpose, "flip": flip, "pixelsort": pixelsort }
+    # filters that move the pixels rather than changing their values
+    moving_filters = ["rotate", "transpose", "flip", "pixelsort"]
+
+
+class Layouts:
+    # Pixel layouts, i.e. the order in which the pixels of the image are visited by the
+    # audio stream. The default raster order (row by row) splits the audio at each row edge,
+    # the other layouts keep neighbours in time close in the image:
+    # - serpentine: row by row, alternating the direction (boustrophedon)
+    # - column: column by column
+    # - hilbert, zorder: space-filling curves
+    #
+    # Each layout is a permutation (stream index -> raster index) computed once per
+    # geometry, then applied using a vectorized gather.
+    names = ["raster", "serpentine", "column", "hilbert", "zorder"]
+
+    # permutations, indexed by (layout, width, height, channels)
+    cache = {}
+    cache_size = 8
+
+    def order(layout, width, height):
+        nb = width * height
+        if layout == "serpentine":
+            grid = np.arange(nb, dtype=np.int64).reshape(height, width)
+            grid[1::2] = grid[1::2, ::-1]
+            return grid.reshape(-1)
+        elif layout == "column":
+            return np.arange(nb, dtype=np.int64).reshape(height, width).T.reshape(-1)
+        elif layout == "hilbert":
+            y, x = np.divmod(np.arange(nb, dtype=np.int64), width)
+            return np.argsort(Layouts.hilbert_index(x, y, max(width, height)), kind="stable")
+        elif layout == "zorder":
+            y, x = np.divmod(np.arange(nb, dtype=np.int64), width)
+            return np.argsort(Layouts.spread_bits(x) | (Layouts.spread_bits(y) << 1), kind="stable")
+        else:
+            raise ValueError("Unknown layout: " + str(layout))
+
+    def hilbert_index(x, y, size):
+        # position of each (x, y) pixel on the Hilbert curve that covers a square of
+        # size n * n, n being the smallest power of 2 greater or equal to size
+        n = 1 << int(ceil(np.log2(max(size, 2))))
+        x = x.copy()
+        y = y.copy()
+        d = np.zeros(len(x), dtype=np.int64)
+        s = n // 2
+        while s > 0:
+            rx = (x & s) > 0
+            ry = (y & s) > 0
+            d += s * s * ((3 * rx) ^ ry)
+            # rotate the quadrant
+            flip = (~ry) & rx
+            x = np.where(flip, n - 1 - x, x)
+            y = np.where(flip, n - 1 - y, y)
+            x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+            s //= 2
+        return d
+
+    def spread_bits(v):
+        # insert a 0 bit between each bit of v (used by the Morton code)
+        v = v.astype(np.uint64)
+        v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return v
+
+    def indices(layout, width, height, channels):
+        key = (layout, width, height, channels)
+        if not key in Layouts.cache:
+            order = Layouts.order(layout, width, height)
+            dtype = np.int32 if width * height < 2 ** 31 else np.int64
+            inverse = np.empty(len(order), dtype=dtype)
+            inverse[order] = np.arange(len(order), dtype=dtype)
+            if len(Layouts.cache) >= Layouts.cache_size:
+                del Layouts.cache[next(iter(Layouts.cache))]
+            Layouts.cache[key] = (order.astype(dtype), inverse)
+        return Layouts.cache[key]
+
+    def is_raster(layout):
+        return layout == None or layout == "raster"
+
+    # reorder the pixels of an image (raster order) following the layout
+    def to_stream(data, width, height, channels, layout):
+        if Layouts.is_raster(layout):
+            return data
+        if len(data) != width * height * channels:
+            raise ConversionError("The " + layout + " layout requires a complete image")
+        order, inverse = Layouts.indices(layout, width, height, channels)
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(-1, channels)
+        return memoryview(np.take(pixels, order, axis=0).reshape(-1))
+
+    # place the pixels of a stream in an image (raster order) following the layout
+    def from_stream(data, width, height, channels, layout):
+        if Layouts.is_raster(layout):
+            return data
+        order, inverse = Layouts.indices(layout, width, height, channels)
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(-1, channels)
+        return memoryview(np.take(pixels, inverse, axis=0).reshape(-1))
+
+
+class Planar:
+    # Planar mapping between the audio stream and the colour planes of the image. By
+    # default (interleaved), consecutive bytes are consecutive components of the pixels,
+    # thus the stereo samples rotate over the R, G and B components.
+    #
+    # - channels: one pixel per audio frame, each audio channel filling whole planes (mono:
+    #   R, G and B; stereo: left -> R, right -> B, the G plane being the mean of both).
+    #   The alpha plane is opaque. Back to audio, mono is the mean of the colour planes.
+    # - segments: the stream is split in contiguous parts (thirds for RGB), each part
+    #   filling a plane.
+    #
+    # All the mappings are vectorized reshape/transpose operations.
+    names = ["interleaved", "channels", "segments"]
+
+    def is_interleaved(planar):
+        return planar == None or planar == "interleaved"
+
+    # contiguous planes -> interleaved pixels
+    def interleave(data, pixel_channels):
+        if pixel_channels == 1:
+            return data
+        planes = Buffers.array(data).reshape(pixel_channels, -1)
+        return memoryview(np.ascontiguousarray(planes.T).reshape(-1))
+
+    # interleaved pixels -> contiguous planes
+    def deinterleave(data, pixel_channels):
+        if pixel_channels == 1:
+            return data
+        pixels = Buffers.array(data).reshape(-1, pixel_channels)
+        return memoryview(np.ascontiguousarray(pixels.T).reshape(-1))
+
+    # 8-bits samples (audio frames) -> pixels (one per frame)
+    def audio_to_pixels(data, audio_channels, pixel_channels):
+        samples = Buffers.array(data).view(np.int8)
+        frames = samples[:len(samples) - len(samples) % audio_channels].reshape(-1, audio_channels)
+        pixels = np.empty((len(frames), pixel_channels), dtype=np.int8)
+        if audio_channels == 1:
+            pixels[:, :min(pixel_channels, 3)] = frames
+        elif pixel_channels == 1:
+            raise ConversionError("The planar channel mapping of a stereo audio requires a color image")
+        else:
+            pixels[:, 0] = frames[:, 0]
+            pixels[:, 1] = (frames[:, 0].astype(np.int16) + frames[:, 1]) >> 1
+            pixels[:, 2] = frames[:, 1]
+        if pixel_channels == 4:
+            pixels[:, 3] = -1
+        return memoryview(pixels.reshape(-1)).cast("B")
+
+    # pixels -> 8-bits samples
+    def pixels_to_audio(data, pixel_channels, audio_channels):
+        pixels = Buffers.array(data).view(np.int8)
+        pixels = pixels[:len(pixels) - len(pixels) % pixel_channels].reshape(-1, pixel_channels)
+        if audio_channels == 1:
+            colors = pixels[:, :min(pixel_channels, 3)]
+            frames = np.rint(colors.mean(axis=1)).astype(np.int8) if pixel_channels > 1 else colors
+        elif pixel_channels == 1:
+            raise ConversionError("The planar channel mapping of a stereo audio requires a color image")
+        else:
+            frames = np.stack([pixels[:, 0], pixels[:, 2]], axis=1)
+        return memoryview(np.ascontiguousarray(frames).reshape(-1)).cast("B")
+
+
+class FFmpeg:
+    # Encoding of the audio formats that are not written by Python (mp3, ogg, flac...):
+    # the PCM data is given to ffmpeg on its standard input in chunks, and ffmpeg writes
+    # the output file itself. AudioSegment.export writes a temporary WAV file, and the
+    # encoded file in another temporary file before copying it: on large files, this
+    # triples the disk traffic, and fails if the temporary directory is too small.
+    #
+    # The command is the one of AudioSegment.export (default codecs, tags).
+
+    # raw formats of ffmpeg, by sample width (the 8-bits samples of pydub are signed)
+    sample_formats = {1: "s8", 2: "s16le", 3: "s24le", 4: "s32le"}
+
+    def encode(au, filename, format, tags = None, progress = None):
+        command = [AudioSegment.converter, "-y", "-v", "error", "-nostdin",
+                   "-f", FFmpeg.sample_formats[au.sample_width], "-ar", str(au.frame_rate), "-ac", str(au.channels), "-i", "pipe:0"]
+        codec = AudioSegment.DEFAULT_CODECS.get(format)
+        if codec != None:
+            command += ["-acodec", codec]
+        for key, value in (tags if tags != None else {}).items():
+            command += ["-metadata", "{0}={1}".format(key, value)]
+        if tags != None and format == "mp3":
+            command += ["-id3v2_version", "4"]
+        command += ["-f", format, str(filename)]
+
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=0)
+        # the messages are read while the data is written, to avoid blocking ffmpeg
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            errors = executor.submit(process.stderr.read)
+            try:
+                data = memoryview(au.raw_data).cast("B")
+                total = len(data)
+                Progress.report(progress, "encode", 0, total)
+                for position in range(0, total, Buffers.chunk_size):
+                    process.stdin.write(data[position:position + Buffers.chunk_size])
+                    Progress.report(progress, "encode", min(total, position + Buffers.chunk_size), total)
+            except BrokenPipeError:
+                # ffmpeg stopped, the error is given by its messages
+                pass
+            except:
+                process.kill()
+                raise
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+                process.wait()
+        if process.returncode != 0:
+            raise ConversionError("Encoding failed (ffmpeg error code " + str(process.returncode) + "): " + errors.result().decode(errors="ignore").strip())
+
+
+class SegmentedDecoder:
+    # Decoding of compressed audio files by ffmpeg, the PCM data being read from its
+    # standard output in chunks, straight into a preallocated buffer (without temporary
+    # file nor intermediate WAV copy). The samples are the ones of AudioSegment.from_file
+    # (same sample format, no resampling), which is only used for the sample formats that
+    # are converted by pydub (8 and 24 bits).
+    #
+    # Long files are split in time segments, decoded concurrently by several ffmpeg
+    # processes, each one writing its PCM data at its offset of the buffer.
+    #
+    # A segment is decoded from a seek point before its offset (on a microsecond, thus at an
+    # exact sample), the first samples being dropped while the decoder state settles. The
+    # end of these samples is compared to the previous segment to find the exact join (a
+    # few samples around the expected one). If a join cannot be found without ambiguity
+    # (inexact seeking, e.g. in VBR mp3 files without index, or silence), the file is
+    # decoded again by a single process.
+    #
+    # number of ffmpeg processes, 1 to disable the parallel decoding (see --decode-jobs)
+    jobs = os.cpu_count()
+    # shorter files (seconds) are decoded by a single process
+    min_duration = 120
+    min_segment_duration = 30
+    # samples decoded before each segment, compared to the previous one (seconds)
+    settle_duration = 0.5
+    check_duration = 0.1
+    # maximal distance to the expected join (samples)
+    max_shift = 64
+
+    # sample format, duration and conversion record (see Metadata) of the first audio
+    # stream, or None if not supported
+    def stream_info(filename):
+        info = pydub.utils.mediainfo_json(filename)
+        streams = [s for s in info.get("streams", []) if s.get("codec_type") == "audio"]
+        if len(streams) == 0:
+            return None
+        stream = streams[0]
+        # sample format chosen by AudioSegment.from_file
+        if stream.get("sample_fmt") == "fltp" and stream.get("codec_name") in ["mp3", "mp4", "aac", "webm", "ogg"]:
+            bits = 16
+        else:
+            bits = int(stream.get("bits_per_sample", 0))
+        if not bits in [16, 32]:
+            return None
+        try:
+            duration = float(stream.get("duration", info.get("format", {}).get("duration")))
+        except (TypeError, ValueError):
+            return None
+        # the comment tag can be stored by the container or by the stream (Vorbis comments)
+        tags = dict(info.get("format", {}).get("tags", {}))
+        tags.update(stream.get("tags", {}))
+        return {"frame_rate": int(stream["sample_rate"]), "channels": int(stream["channels"]),
+                "sample_width": bits // 8, "duration": duration, "record": Metadata.read_tags(tags)}
+
+    # the decoded audio (as AudioSegment.from_file). If the stream has been probed, its
+    # conversion_record is set, thus the file is not probed again to read the metadata
+    def decode(filename, verbose = False, progress = None):
+        info = None
+        if isinstance(filename, (str, os.PathLike)) and not os.path.splitext(str(filename))[1].lower() in PCMCache.uncached_extensions:
+            try:
+                info = SegmentedDecoder.stream_info(filename)
+            except Exception:
+                info = None
+        if info == None:
+            return AudioSegment.from_file(filename)
+
+        count = 1
+        if info["duration"] >= SegmentedDecoder.min_duration:
+            count = max(1, min(SegmentedDecoder.jobs, int(info["duration"] // SegmentedDecoder.min_segment_duration)))
+        au = SegmentedDecoder.try_decode_segments(filename, info, count, verbose, progress)
+        if au == None and count > 1:
+            print("Unable to join the decoded segments, decoding with a single process")
+            au = SegmentedDecoder.try_decode_segments(filename, info, 1, verbose, progress)
+        if au == None:
+            au = AudioSegment.from_file(filename)
+        au.conversion_record = info["record"]
+        return au
+
+    def try_decode_segments(filename, info, count, verbose, progress):
+        try:
+            return SegmentedDecoder.decode_segments(filename, info, count, verbose, progress)
+        except Cancelled:
+            raise
+        except Exception:
+            return None
+
+    # ffmpeg time of a sample (the seek points are exact samples on microseconds)
+    def seek_point(frame, frame_rate):
+        step = frame_rate // gcd(frame_rate, 10 ** 6)
+        frame -= frame % step
+        us = frame * 10 ** 6 // frame_rate
+        return frame, "{}.{:06d}".format(us // 10 ** 6, us % 10 ** 6)
+
+    def decode_segments(filename, info, count, verbose, progress):
+        frame_rate = info["frame_rate"]
+        frame_size = info["channels"] * info["sample_width"]
+        codec = FFmpeg.sample_formats[info["sample_width"]]
+        nb_frames = int(round(info["duration"] * frame_rate))
+        starts = [i * nb_frames // count for i in range(count)]
+        shift = SegmentedDecoder.max_shift
+        settle = int(SegmentedDecoder.settle_duration * frame_rate)
+        check = int(SegmentedDecoder.check_duration * frame_rate)
+        if verbose and count > 1:
+            print("Decoding", count, "segments of", "{:.1f}".format(info["duration"] / count), "s")
+
+        # the duration is an estimation: one more second is allocated, the end of the last
+        # segment being appended if it is still too short
+        data = bytearray((nb_frames + frame_rate) * frame_size)
+        written = [0] * count
+        cancelled = [False]
+
+        # decode segment i: the first samples (head) in a separate buffer, the others at
+        # their offset, from start + shift to the next start + shift (or the end of file).
+        # Returns (head, first frame of the head, end of the data in bytes, extra data)
+        def segment(i):
+            command = [AudioSegment.converter, "-v", "error", "-nostdin"]
+            if i > 0:
+                seek, timestamp = SegmentedDecoder.seek_point(starts[i] - settle - shift, frame_rate)
+                command += ["-ss", timestamp]
+            else:
+                seek = 0
+            command += ["-i", str(filename), "-vn", "-acodec", "pcm_" + codec, "-f", codec, "-"]
+            head = bytearray((starts[i] + shift - seek) * frame_size if i > 0 else 0)
+            begin = len(head) + seek * frame_size
+            end = len(data) if i == count - 1 else (starts[i + 1] + shift) * frame_size
+            extra = []
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                # readinto can return less bytes than asked (pipe)
+                done = 0
+                with memoryview(head) as view:
+                    while done < len(head):
+                        n = process.stdout.readinto(view[done:])
+                        if n == 0:
+                            return None
+                        done += n
+                position = begin
+                with memoryview(data) as view:
+                    while position < end and not cancelled[0]:
+                        n = process.stdout.readinto(view[position:min(end, position + Buffers.chunk_size)])
+                        if n == 0:
+                            break
+                        position += n
+                        written[i] = position - begin
+                if i == count - 1:
+                    for block in iter(lambda: process.stdout.read(Buffers.chunk_size), b""):
+                        if cancelled[0]:
+                            break
+                        extra.append(block)
+                    if process.wait() != 0:
+                        return None
+                elif position < end:
+                    return None
+            finally:
+                process.kill()
+                process.wait()
+            return head, seek, position, extra
+
+        total = nb_frames * frame_size
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(segment, i) for i in range(count)]
+            try:
+                remaining = set(futures)
+                while len(remaining) != 0:
+                    done, remaining = wait(remaining, timeout=0.5)
+                    Progress.report(progress, "decode", min(total, sum(written)), total)
+                results = [f.result() for f in futures]
+                Progress.report(progress, "decode", total, total)
+            except Cancelled:
+                cancelled[0] = True
+                raise
+        if None in results:
+            return None
+
+        # the end of the last segment
+        end, extra = results[-1][2:]
+        if len(extra) != 0:
+            data = data[:end] + b"".join(extra)
+            end = len(data)
+        ends = [r[2] for r in results[:-1]] + [end]
+
+        # join the segments, the previous ones being at their final position
+        for i in range(1, count):
+            head, seek = results[i][:2]
+            previous = data[(starts[i] - check) * frame_size:starts[i] * frame_size]
+            # head[k] is the frame seek + delta + k
+            matches = [delta for delta in range(-shift, shift + 1)
+                       if head[(starts[i] - check - seek - delta) * frame_size:(starts[i] - seek - delta) * frame_size] == previous]
+            if len(matches) != 1:
+                if verbose:
+                    print("No join found for segment", i)
+                return None
+            offset = matches[0] * frame_size
+
+            # move the data of the segment. The end of a segment overlaps the head of the
+            # next one, thus it is dropped if the segment moves forward
+            begin = (starts[i] + shift) * frame_size
+            length = ends[i] - begin
+            if i < count - 1:
+                length -= max(0, offset)
+            else:
+                end += offset
+                if end > len(data):
+                    data.extend(bytes(end - len(data)))
+            if offset != 0:
+                if verbose:
+                    print("Segment", i, "moved by", matches[0], "samples")
+                array = np.frombuffer(data, dtype=np.uint8)
+                array[begin + offset:begin + offset + length] = array[begin:begin + length]
+                del array
+            # the first frames of the segment, from the head
+            first = (starts[i] - seek) * frame_size - offset
+            data[starts[i] * frame_size:begin + offset] = head[first:first + begin + offset - starts[i] * frame_size]
+
+        end -= end % frame_size
+        return AudioSegment(data = memoryview(data)[:end], sample_width = info["sample_width"],
+                            frame_rate = frame_rate, channels = info["channels"])
+
+
+class PCMCache:
+    # On-disk cache of the decoded PCM data of compressed audio files (mp3, ogg, flac...),
+    # to avoid running ffmpeg again when the same file is converted several times.
+    #
+    # Entries are indexed by the hash of the file content. The path, modification time and
+    # size of the files are also stored, to skip the hash computation for a known file.
+    # The PCM data are memory-mapped when loaded, and the least recently used entries are
+    # removed when the cache is larger than max_size.
+    #
+    # Several processes can use the cache (e.g. the workers of a manifest): the index is
+    # read, modified and written while holding a lock, and an entry is added to the index
+    # in the same step as its PCM file is renamed, thus a PCM file that is not in the index
+    # is an orphan (e.g. from an interrupted run).
+    cache_dir = pathlib.Path(user_cache_dir("rawdodendron")).joinpath("pcm")
+    index_file = cache_dir.joinpath("index.json")
+    lock_file = cache_dir.joinpath("index.lock")
+    # maximum size of the cache (in bytes), 0 to disable it
+    max_size = 2 << 30
+    # formats that are decoded quickly, and thus not cached
+    uncached_extensions = [".wav", ".raw"]
+
+    def is_cacheable(filename):
+        if PCMCache.max_size <= 0 or not isinstance(filename, (str, os.PathLike)):
+            return False
+        extension = os.path.splitext(str(filename))[1].lower()
+        return not extension in PCMCache.uncached_extensions and not Utils.is_image_filename(str(filename))
+
+    # exclusive lock of the index, released when the block ends
+    class IndexLock:
+        def __enter__(self):
+            self.file = None
+            try:
+                os.makedirs(PCMCache.cache_dir, exist_ok=True)
+                self.file = open(PCMCache.lock_file, "a")
+                if fcntl != None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            except OSError:
+                pass
+            return self
+
+        def __exit__(self, *exception):
+            # closing the file releases the lock
+            if self.file != None:
+                self.file.close()
+
+    def load_index():
+        try:
+            with open(PCMCache.index_file) as f:
+                return json.load(f)
+        except:
+            return {"entries": {}, "files": {}}
+
+    def store_index(index):
+        tmp = str(PCMCache.index_file) + "." + str(os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, PCMCache.index_file)
+
+    def content_hash(filename):
+        h = hashlib.blake2b(digest_size=20)
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def entry_file(key):
+        return PCMCache.cache_dir.joinpath(key + ".pcm")
+
+    # the decoded audio, from the cache if possible. The progress (if any) is reported
+    # by chunks for PCM WAV files, before and after decoding for the other formats
+    def decode(filename, verbose = False, progress = None):
+        if not PCMCache.is_cacheable(filename):
+            if progress != None and isinstance(filename, (str, os.PathLike)):
+                au = Progress.read_wav(filename, progress)
+                if au != None:
+                    return au
+            return SegmentedDecoder.decode(filename, verbose, progress)
+
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        with PCMCache.IndexLock():
+            index = PCMCache.load_index()
+
+        # identify the file content (the hash is computed only if the file changed)
+        known = index["files"].get(path)
+        if known != None and known["mtime"] == stat.st_mtime_ns and known["size"] == stat.st_size:
+            key = known["hash"]
+        else:
+            key = PCMCache.content_hash(path)
+
+        entry = index["entries"].get(key)
+        au = None
+        tmp = None
+        broken = None
+        if entry != None:
+            try:
+                au = PCMCache.map(key, entry)
+                if verbose:
+                    print("Decoded audio loaded from cache")
+            except (OSError, ValueError):
+                broken = entry
+
+        if au == None:
+            Progress.report(progress, "decode", 0, stat.st_size)
+            au = SegmentedDecoder.decode(filename, verbose, progress)
+            Progress.report(progress, "decode", stat.st_size, stat.st_size)
+            tmp, entry = PCMCache.store(key, au)
+
+        # merge the entry in the current index, that may have been modified by other
+        # processes since it was read
+        with PCMCache.IndexLock():
+            index = PCMCache.load_index()
+            index["files"][path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": key}
+            if tmp != None:
+                try:
+                    os.replace(tmp, PCMCache.entry_file(key))
+                    index["entries"][key] = entry
+                except OSError:
+                    pass
+            elif broken != None and index["entries"].get(key) == broken:
+                del index["entries"][key]
+            if key in index["entries"]:
+                index["entries"][key]["last_used"] = time.time()
+            PCMCache.evict(index)
+            try:
+                PCMCache.store_index(index)
+            except OSError:
+                pass
+        return au
+
+    # memory-map the PCM data of an entry
+    def map(key, entry):
+        with open(PCMCache.entry_file(key), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) != entry["length"]:
+            raise ValueError("Incomplete cache entry")
+        au = AudioSegment(data = memoryview(data), sample_width = entry["sample_width"],
+                          frame_rate = entry["frame_rate"], channels = entry["channels"])
+        # the metadata of the file, read when it was decoded
+        if "record" in entry:
+            au.conversion_record = entry["record"]
+        return au
+
+    # write the PCM data in a temporary file, renamed when the entry is added to the index.
+    # Returns the temporary file and the entry, or (None, None)
+    def store(key, au):
+        if len(au.raw_data) > PCMCache.max_size:
+            return None, None
+        try:
+            os.makedirs(PCMCache.cache_dir, exist_ok=True)
+            tmp = str(PCMCache.entry_file(key)) + "." + str(os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(au.raw_data)
+        except OSError:
+            return None, None
+        entry = {"sample_width": au.sample_width, "frame_rate": au.frame_rate, "channels": au.channels,
+                 "length": len(au.raw_data), "last_used": time.time()}
+        if hasattr(au, "conversion_record"):
+            entry["record"] = au.conversion_record
+        return tmp, entry
+
+    # remove the least recently used entries
+    def evict(index):
+        entries = index["entries"]
+        total = sum(e["length"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= PCMCache.max_size:
+                break
+            total -= entries[key]["length"]
+            del entries[key]
+            try:
+                os.remove(PCMCache.entry_file(key))
+            except OSError:
+                pass
+        # forget the files whose content is not cached anymore
+        index["files"] = {p: f for p, f in index["files"].items() if f["hash"] in entries}
+        # remove the orphan PCM files
+        try:
+            for name in os.listdir(PCMCache.cache_dir):
+                if name.endswith(".pcm") and not name[:-len(".pcm")] in entries:
+                    os.remove(PCMCache.cache_dir.joinpath(name))
+        except OSError:
+            pass
+
+
+class AudioReader:
+    # Read an audio file as a stream of 8-bits samples (signed, as in AudioSegment), without
+    # loading the whole file when the format allows it (PCM WAV files). Other formats are
+    # decoded by pydub. A stream of raw 8-bits samples (see Streams) can also be read,
+    # its (channels, frame_rate) being given.
+    # length is the number of 8-bits samples (None if unknown)
+    def __init__(self, filename, verbose = False, raw = None):
+        self.wave = None
+        self.audio = None
+        self.stream = None
+        self.length = None
+        if raw != None:
+            self.stream = filename
+            self.channels, self.frame_rate = raw
+            self.sample_width = 1
+        else:
+            try:
+                self.wave = wave.open(filename, "rb")
+                self.frame_rate = self.wave.getframerate()
+                self.channels = self.wave.getnchannels()
+                self.sample_width = self.wave.getsampwidth()
+                if not Utils.is_stdin(filename):
+                    self.length = self.wave.getnframes() * self.channels
+            except (wave.Error, EOFError):
+                self.audio = PCMCache.decode(filename).set_sample_width(1)
+                self.frame_rate = self.audio.frame_rate
+                self.channels = self.audio.channels
+                self.sample_width = 1
+                self.length = len(self.audio.raw_data)
+        if verbose:
+            print("Audio properties: ", "channels:", self.channels, ", sample_width:", self.sample_width, ", frame_rate", self.frame_rate, file=sys.stderr)
+
+    # iterate over chunks of 8-bits samples, of about size bytes
+    def chunks(self, size):
+        nb_frames = max(1, size // self.channels)
+        if self.wave != None:
+            while True:
+                data = self.wave.readframes(nb_frames)
+                if len(data) == 0:
+                    break
+                if self.sample_width == 1:
+                    # convert from unsigned integers in wav
+                    yield audioop.bias(data, 1, -128)
+                else:
+                    yield audioop.lin2lin(data, self.sample_width, 1)
+        elif self.stream != None:
+            while True:
+                data = self.stream.read(nb_frames * self.channels)
+                if len(data) < self.channels:
+                    break
+                yield data[:len(data) - len(data) % self.channels]
+        else:
+            data = memoryview(self.audio.raw_data)
+            for start in range(0, len(data), nb_frames * self.channels):
+                yield data[start:start + nb_frames * self.channels]
+
+    def close(self):
+        if self.wave != None:
+            self.wave.close()
+
+
+class Streams:
+    # Standard input and output (-i - and -o -), to chain rawdodendron with other tools
+    # without temporary files. The format of the streams cannot be guessed from an
+    # extension, it is given by --input-format and --output-format.
+    #
+    # raw is a stream of signed 8-bits samples (as sox -t s8), described by --bitrate and
+    # --mono/--stereo. Audio is written in chunks, and read in chunks by the videos (see
+    # AudioReader). Images are encoded/decoded by PIL.
+    formats = ["raw", "wav", "png", "ppm", "pgm"]
+    image_formats = {"png": "PNG", "ppm": "PPM", "pgm": "PPM"}
+    chunk_size = 1 << 20
+
+    # the binary standard output, even when messages are redirected to stderr
+    def stdout():
+        return sys.__stdout__.buffer
+
+    def stdin():
+        return sys.__stdin__.buffer
+
+    def is_image_format(format):
+        return format in Streams.image_formats
+
+    # is the given output (file or stream) an image
+    def is_image_output(output, args):
+        if Utils.is_stdout(output):
+            return Streams.is_image_format(Streams.output_format(args))
+        return Utils.is_image_filename(output.name)
+
+    def output_format(args):
+        if args.output_format == None:
+            raise ConversionError("The format of the standard output is required (--output-format)")
+        return args.output_format
+
+    # properties of a raw input stream
+    def raw_properties(args):
+        return (1 if args.mono else 2), (args.bitrate if args.bitrate != None else 44100)
+
+    def guess_format(data):
+        if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+            return "wav"
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return "png"
+        if data[:2] in [b"P6", b"P3"]:
+            return "ppm"
+        if data[:2] in [b"P5", b"P2"]:
+            return "pgm"
+        return None
+
+    # load the standard input as an image or an AudioSegment
+    def load(stream, args):
+        data = stream.read()
+        format = args.input_format if args.input_format != None else Streams.guess_format(data)
+        if format == None:
+            raise ConversionError("Unable to guess the format of the standard input, use --input-format")
+        if args.verbose:
+            print("Standard input:", len(data), "bytes, format:", format)
+
+        if Streams.is_image_format(format):
+            return Image.open(io.BytesIO(data))
+        if format == "raw":
+            channels, frame_rate = Streams.raw_properties(args)
+            au = AudioSegment(data = data[:len(data) - len(data) % channels], sample_width = 1, frame_rate = frame_rate, channels = channels)
+            au.conversion_record = None
+        else:
+            # the sizes of a streamed wav file may be wrong, they are fixed by pydub
+            au = AudioSegment(data = data)
+            au.conversion_record = Metadata.read_wav(io.BytesIO(data))
+        return au
+
+    # write the samples of an AudioSegment in chunks. The size of the audio is known
+    # before writing, so that the wav header does not need to be rewritten
+    def write_audio(au, stream, format):
+        data = memoryview(au.raw_data)
+        step = Streams.chunk_size - Streams.chunk_size % au.frame_width
+        if format == "wav":
+            w = wave.open(stream, "wb")
+            w.setnchannels(au.channels)
+            w.setsampwidth(au.sample_width)
+            w.setframerate(au.frame_rate)
+            w.setnframes(int(au.frame_count()))
+            for start in range(0, len(data), step):
+                chunk = data[start:start + step]
+                # wav files use unsigned 8-bits samples
+                w.writeframesraw(audioop.bias(chunk, 1, 128) if au.sample_width == 1 else chunk)
+            w.close()
+        elif format == "raw":
+            for start in range(0, len(data), step):
+                stream.write(data[start:start + step])
+        else:
+            raise ConversionError("Unsupported audio format for the standard output: " + format)
+        stream.flush()
+
+
+class Video:
+    # Convert an audio file to a video, each frame being a moving window over the
+    # raw audio stream (see Rawdodendron.save_as_image for the conversion of a frame).
+    #
+    # The frames are written while the audio is read, as an uncompressed YUV4MPEG2
+    # stream (y4m) or as raw video (interleaved pixels, e.g. for ffmpeg -f rawvideo).
+    # Only one frame and one read buffer are kept in memory.
+    formats = ["y4m", "raw"]
+
+    def is_video_output(args):
+        return args.video != None or os.path.splitext(args.output.name)[1].lower() == ".y4m"
+
+    def frame_geometry(args, frame_rate, audio_channels):
+        if args.width != None and args.frame_height != None:
+            return args.width, args.frame_height
+        # use the amount of audio shown in a frame
+        length = int(args.frame_duration * frame_rate * audio_channels / 1000)
+        width, height, missing = Rawdodendron.get_image_size_from_length(length, args)
+        return width, max(1, height)
+
+    def rgb_to_ycbcr(pixels):
+        # full range BT.601 conversion (as in JPEG), planar output
+        p = pixels[:, :, :3].astype(np.float32)
+        y = 0.299 * p[:, :, 0] + 0.587 * p[:, :, 1] + 0.114 * p[:, :, 2]
+        cb = 128 - 0.168736 * p[:, :, 0] - 0.331264 * p[:, :, 1] + 0.5 * p[:, :, 2]
+        cr = 128 + 0.5 * p[:, :, 0] - 0.418688 * p[:, :, 1] - 0.081312 * p[:, :, 2]
+        return np.clip(np.rint(np.stack([y, cb, cr])), 0, 255).astype(np.uint8)
+
+    def y4m_header(width, height, fps, mode):
+        colorspace = "mono" if mode == "L" else "444"
+        return "YUV4MPEG2 W{} H{} F{}:{} Ip A1:1 C{} XCOLORRANGE=FULL\n".format(width, height, fps[0], fps[1], colorspace).encode()
+
+    def encode_frame(data, width, height, mode, args):
+        channels = len(mode)
+        # place the pixels following the planar mapping and the layout, then apply the image filters
+        if args.planar == "segments":
+            data = Planar.interleave(bytes(data), channels)
+        data = Layouts.from_stream(bytes(data), width, height, channels, args.layout)
+        data, w, h = ImageFilters.apply(data, width, height, channels, args.image_filter)
+        if (w, h) != (width, height):
+            raise ConversionError("Image filters cannot change the size of the video frames")
+        if args.video == "raw":
+            return data
+        if mode == "L":
+            return b"FRAME\n" + data
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+        return b"FRAME\n" + Video.rgb_to_ycbcr(pixels).tobytes()
+
+    def save_as_video(args):
+        Utils.check_effects(args, False)
+        log = sys.stderr
+        if not Utils.is_stdin(args.input):
+            reader = AudioReader(args.input.name, args.verbose)
+        elif args.input_format == "raw":
+            reader = AudioReader(Streams.stdin(), args.verbose, Streams.raw_properties(args))
+        elif args.input_format in [None, "wav"]:
+            reader = AudioReader(Streams.stdin(), args.verbose)
+        else:
+            raise ConversionError("The standard input of a video must be an audio stream (raw or wav)")
+
+        # set default values (the history describes still images, not videos)
+        History().consolidate_parameters_from_audio(args, None)
+        if args.planar == "channels":
+            raise ConversionError("The channels planar mapping is not supported for videos")
+        if args.video == None:
+            args.video = "y4m"
+
+        mode = "L" if args.greyscale else "RGBA" if args.rgba else "RGB"
+        width, height = Video.frame_geometry(args, reader.frame_rate, reader.channels)
+        frame_size = width * height * len(mode)
+
+        # number of bytes between two frames (a multiple of the audio frame size)
+        bytes_per_second = reader.frame_rate * reader.channels
+        hop = args.frame_duration if args.hop == None else args.hop
+        hop = max(1, int(hop * reader.frame_rate / 1000)) * reader.channels
+        fps = (bytes_per_second // gcd(bytes_per_second, hop), hop // gcd(bytes_per_second, hop))
+        if args.video == "y4m" and mode == "RGBA":
+            print("Alpha channel is not supported by y4m, it will be ignored", file=log)
+
+        print("Video frames:", width, "*", height, "pixels, mode:", mode, ", frame rate:", "{:.3f}".format(fps[0] / fps[1]), "fps", file=log)
+
+        if Utils.is_stdout(args.output):
+            output = Streams.stdout()
+        else:
+            output = open(args.output.name, "wb")
+
+        try:
+            if args.video == "y4m":
+                output.write(Video.y4m_header(width, height, fps, mode))
+
+            nb_frames = 0
+            window = bytearray()
+            skip = 0
+            fresh = 0
+            nb_samples = 0
+            for chunk in reader.chunks(max(hop, 1 << 16)):
+                nb_samples += len(chunk)
+                Progress.report(args.progress, "convert", nb_samples, reader.length)
+                chunk = Rawdodendron.apply_conversion(chunk, args)
+                position = 0
+                while position < len(chunk):
+                    if skip > 0:
+                        # the hop is larger than a frame
+                        step = min(skip, len(chunk) - position)
+                        position += step
+                        skip -= step
+                        continue
+                    part = chunk[position:position + frame_size - len(window)]
+                    window += part
+                    position += len(part)
+                    fresh += len(part)
+                    if len(window) == frame_size:
+                        output.write(Video.encode_frame(window, width, height, mode, args))
+                        nb_frames += 1
+                        fresh = 0
+                        if hop >= frame_size:
+                            window.clear()
+                            skip = hop - frame_size
+                        else:
+                            del window[:hop]
+
+            # last incomplete frame
+            if fresh > 0 and not args.truncate:
+                window += b"\x00" * (frame_size - len(window))
+                output.write(Video.encode_frame(window, width, height, mode, args))
+                nb_frames += 1
+
+            Progress.terminal_end()
+            print("Number of frames:", nb_frames, file=log)
+        finally:
+            reader.close()
+            if output is not Streams.stdout():
+                output.close()
+            else:
+                output.flush()
+
+
+class Progress:
+    # Progress and cancellation of a conversion. The conversion core reports the number of
+    # bytes processed in each stage (decode, convert, encode) to callback(stage, done, total),
+    # total being None when it is unknown (e.g. the size of a compressed output).
+    #
+    # cancel() can be called from the callback, another thread or a signal handler: the
+    # conversion raises Cancelled at the next report, and the partial outputs are removed.
+    # The progress is given to the conversion core in args.progress (None if not used).
+    stages = ["decode", "convert", "encode"]
+    # exit code of the command line when the conversion is cancelled (as after SIGINT)
+    exit_code = 130
+
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def update(self, stage, done, total = None):
+        if self.cancelled:
+            raise Cancelled("Conversion cancelled")
+        if self.callback != None:
+            self.callback(stage, done, total)
+
+    # report the progress if a progress is given
+    def report(progress, stage, done, total = None):
+        if progress != None:
+            progress.update(stage, done, total)
+
+    # a file object that reports the bytes read or written. It has no fileno, thus the
+    # PIL encoders and decoders use read() and write() by blocks rather than the file
+    # descriptor
+    class File:
+        def __init__(self, f, progress, stage, total = None):
+            self.f = f
+            self.progress = progress
+            self.stage = stage
+            self.total = total
+            self.done = 0
+
+        def read(self, size = -1):
+            data = self.f.read(size)
+            self.done += len(data)
+            self.progress.update(self.stage, self.done, self.total)
+            return data
+
+        def write(self, data):
+            result = self.f.write(data)
+            self.done += len(data)
+            self.progress.update(self.stage, self.done, self.total)
+            return result
+
+        def __getattr__(self, name):
+            if name == "fileno":
+                raise AttributeError(name)
+            return getattr(self.f, name)
+
+    # decode a PCM WAV file in chunks (as AudioSegment.from_file), or None if the file
+    # cannot be read by the wave module (compressed, 24-bits or extensible formats)
+    def read_wav(filename, progress):
+        try:
+            w = wave.open(filename, "rb")
+        except (wave.Error, EOFError):
+            return None
+        with w:
+            if w.getsampwidth() == 3 or w.getcomptype() != "NONE":
+                return None
+            total = w.getnframes() * w.getnchannels() * w.getsampwidth()
+            nb_frames = max(1, Buffers.chunk_size // (w.getnchannels() * w.getsampwidth()))
+            # the samples are read in a buffer of the final size, given to the segment
+            # without copy
+            data = bytearray(total)
+            position = 0
+            Progress.report(progress, "decode", 0, total)
+            while position < total:
+                chunk = w.readframes(nb_frames)
+                if len(chunk) == 0:
+                    break
+                # wav files use unsigned 8-bits samples
+                if w.getsampwidth() == 1:
+                    chunk = audioop.bias(chunk, 1, -128)
+                chunk = chunk[:total - position]
+                data[position:position + len(chunk)] = chunk
+                position += len(chunk)
+                Progress.report(progress, "decode", position, total)
+            if position < total:
+                # truncated file
+                del data[position:]
+            return AudioSegment(data = data, sample_width = w.getsampwidth(), frame_rate = w.getframerate(), channels = w.getnchannels())
+
+    # time of the last line printed by terminal(), 0 if no line is displayed
+    terminal_time = 0
+
+    # callback that displays the progress on a single line of the terminal (stderr)
+    def terminal(stage, done, total):
+        now = time.monotonic()
+        if now - Progress.terminal_time < 0.1 and (total == None or done < total):
+            return
+        Progress.terminal_time = now
+        if total:
+            line = "{}: {:3d}% ({:.1f} MB)".format(stage, min(100, int(100 * done / total)), done / (1 << 20))
+        else:
+            line = "{}: {:.1f} MB".format(stage, done / (1 << 20))
+        print("\r" + line.ljust(40), end="", file=sys.stderr, flush=True)
+
+    # clear the line of terminal()
+    def terminal_end():
+        if Progress.terminal_time != 0:
+            print("\r" + " " * 40 + "\r", end="", file=sys.stderr, flush=True)
+            Progress.terminal_time = 0
+
+
+class Buffers:
+    # Helpers to build the converted payload in a single preallocated buffer: padding is
+    # left as zeros, truncation is a slice, and the byte-to-byte conversion is a lookup
+    # table applied while copying (or in place). The buffers (memoryviews) are given to
+    # the encoders without extra copy.
+
+    # conversion tables, indexed by conversion method
+    tables = {}
+
+    # number of bytes converted at a time
+    chunk_size = 1 << 20
+
+    def conversion_table(method):
+        if method == "linear":
+            return None
+        if not method in Buffers.tables:
+            # the conversions work byte by byte, thus a 256 entries table is exact
+            values = bytes(range(256))
+            functions = {"u-law": audioop.lin2ulaw, "a-law": audioop.lin2alaw,
+                         "inverse u-law": audioop.ulaw2lin, "inverse a-law": audioop.alaw2lin}
+            Buffers.tables[method] = np.frombuffer(functions[method](values, 1), dtype=np.uint8)
+        return Buffers.tables[method]
+
+    def array(data):
+        if isinstance(data, np.ndarray):
+            return data.reshape(-1)
+        return np.frombuffer(data, dtype=np.uint8)
+
+    def is_contiguous(data):
+        return not isinstance(data, np.ndarray) or data.flags.c_contiguous
+
+    def is_writable(data):
+        return isinstance(data, (bytearray, memoryview)) and not memoryview(data).readonly
+
+    # copy src (or its conversion) to dst. dst and src can be the same array.
+    # The progress (if any) is reported after each chunk
+    def fill(dst, src, table, progress = None):
+        if table is None and progress == None:
+            if not dst is src:
+                np.copyto(dst, src)
+        else:
+            # by chunks, to bound the size of the temporary indices.
+            # mode="clip" avoids an intermediate output buffer (indices are always valid)
+            for start in range(0, len(src), Buffers.chunk_size):
+                end = start + Buffers.chunk_size
+                if table is None:
+                    if not dst is src:
+                        np.copyto(dst[start:end], src[start:end])
+                else:
+                    np.take(table, src[start:end], out=dst[start:end], mode="clip")
+                Progress.report(progress, "convert", min(end, len(src)), len(src))
+
+    def length(data):
+        if isinstance(data, Image.Image):
+            return Utils.image_size(data)
+        return len(data)
+
+    # raw data of an image, encoded by chunks in a buffer of final_size bytes (rather
+    # than im.tobytes() that joins a list of chunks), and converted using the table.
+    # The buffer can be given (e.g. a part of a larger buffer)
+    def image_bytes(im, final_size, table, progress = None, buffer = None):
+        im.load()
+        encoder = Image._getencoder(im.mode, "raw", im.mode)
+        encoder.setimage(im.im, (0, 0) + im.size)
+        if buffer is None:
+            buffer = bytearray(final_size)
+        array = Buffers.array(buffer)
+        position = 0
+        while position < final_size:
+            consumed, errcode, data = encoder.encode(max(ImageFile.MAXBLOCK, im.width * 4))
+            size = min(len(data), final_size - position)
+            Buffers.fill(array[position:position + size], Buffers.array(data)[:size], table)
+            position += len(data)
+            Progress.report(progress, "convert", min(position, final_size), final_size)
+            if errcode < 0:
+                raise ConversionError("Encoder error " + str(errcode) + " while reading image")
+            elif errcode:
+                break
+        return memoryview(buffer)
+
+    # build a buffer of final_size bytes from data (bytes-like or image), converting the
+    # bytes using the table. Missing bytes are zeros, extra bytes are ignored. data is
+    # returned as is if nothing has to be done, or converted in place if in_place is set
+    # and it is a writable buffer of the right size.
+    def build(data, final_size, table, progress = None, in_place = False):
+        if isinstance(data, Image.Image):
+            return Buffers.image_bytes(data, final_size, table, progress)
+        if table is None and len(data) == final_size and Buffers.is_contiguous(data):
+            Progress.report(progress, "convert", final_size, final_size)
+            return data
+        if in_place and len(data) == final_size and Buffers.is_writable(data):
+            array = Buffers.array(data)
+            Buffers.fill(array, array, table, progress)
+            return data
+        buffer = bytearray(final_size)
+        size = min(len(data), final_size)
+        Buffers.fill(Buffers.array(buffer)[:size], Buffers.array(data)[:size], table, progress)
+        return memoryview(buffer)
+
+    # 8-bits samples of an audio segment: the most significant byte of each sample (as
+    # AudioSegment.set_sample_width(1)), as a strided view without copy
+    def samples_8bits(au):
+        raw = Buffers.array(au.raw_data)
+        if au.sample_width == 1:
+            return raw
+        return raw[au.sample_width - 1::au.sample_width]
+
+
+class PNGWriter:
+    # PNG encoder of the L, RGB and RGBA images converted from audio (see
+    # --png-compression), used instead of the PIL encoder. These images are close to
+    # noise: a single zlib stream spends most of the time failing to compress them.
+    #
+    # The rows are filtered and deflated by blocks in parallel threads (zlib and numpy
+    # release the GIL), as pigz: each block is a raw deflate stream ended by a sync flush
+    # (the last one by the end of the stream), primed with the end of the previous block,
+    # thus the blocks form a single zlib stream. Its checksum is combined from the
+    # checksums of the blocks, and each block is written in its own IDAT chunk.
+    #
+    # Compressions:
+    # - auto: a sample of the rows is compressed with and without filters. Noise-like
+    #   images are stored (the compression would gain less than 2%), the others are
+    #   compressed at level 6 (as PIL), filtered if the filters help
+    # - stored: no compression, without filters (the fastest)
+    # - fast: level 1, without filters
+    # - best: level 9, filtered if the filters help
+    # - pillow: PIL encoder
+    compressions = ["auto", "stored", "fast", "best", "pillow"]
+    # number of threads, 1 to deflate the blocks one after the other (see --png-jobs)
+    jobs = os.cpu_count()
+    # size of the blocks, and of the sample used by auto (bytes)
+    block_size = 1 << 20
+    sample_size = 256 << 10
+    # compressed size of a sample (ratio) above which the image is stored
+    noise_ratio = 0.98
+    # PNG color type of each mode
+    color_types = {"L": 0, "RGB": 2, "RGBA": 6}
+    # second byte of the zlib header, by compression level
+    zlib_flags = [0x01, 0x01, 0x5e, 0x5e, 0x5e, 0x5e, 0x9c, 0xda, 0xda, 0xda]
+    adler_base = 65521
+
+    # the writer is used for the single frame PNG images of the supported modes
+    def supports(im, output, format, args, append_images):
+        if args.png_compression == "pillow" or append_images != None or not im.mode in PNGWriter.color_types:
+            return False
+        if format != None:
+            return format.upper() == "PNG"
+        name = output if isinstance(output, (str, os.PathLike)) else getattr(output, "name", "")
+        return isinstance(name, (str, os.PathLike)) and os.path.splitext(str(name))[1].lower() == ".png"
+
+    # rows start..stop-1 of the pixels (one row of bytes per line), each one starting
+    # with its filter type. With filters, the filter of each row is chosen as libpng does
+    # (the smallest sum of absolute values of the filtered bytes)
+    def filter_rows(pixels, start, stop, bpp, filters):
+        rows = pixels[start:stop]
+        result = np.zeros((stop - start, pixels.shape[1] + 1), dtype=np.uint8)
+        if not filters:
+            result[:, 1:] = rows
+            return result
+        x = rows.astype(np.int16)
+        up = np.zeros_like(x)
+        up[1:] = x[:-1]
+        if start > 0:
+            up[0] = pixels[start - 1]
+        left = np.zeros_like(x)
+        left[:, bpp:] = x[:, :-bpp]
+        up_left = np.zeros_like(x)
+        up_left[:, bpp:] = up[:, :-bpp]
+        # paeth predictor
+        p = left + up - up_left
+        pa = np.abs(p - left)
+        pb = np.abs(p - up)
+        pc = np.abs(p - up_left)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+        # none, sub, up, average, paeth
+        candidates = np.stack([x, x - left, x - up, x - ((left + up) >> 1), x - paeth]).astype(np.uint8)
+        costs = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        choice = np.argmin(costs, axis=0)
+        result[:, 0] = choice
+        result[:, 1:] = candidates[choice, np.arange(stop - start)]
+        return result
+
+    # compression level and filters of the image
+    def settings(pixels, bpp, compression):
+        if compression == "stored":
+            return 0, False
+        elif compression == "fast":
+            return 1, False
+        count = max(1, min(len(pixels), PNGWriter.sample_size // max(1, pixels.shape[1])))
+        start = (len(pixels) - count) // 2
+        ratios = []
+        for filters in [False, True]:
+            sample = PNGWriter.filter_rows(pixels, start, start + count, bpp, filters).tobytes()
+            ratios.append(len(zlib.compress(sample, 1)) / len(sample))
+        if compression == "best":
+            return 9, ratios[1] < ratios[0]
+        if min(ratios) >= PNGWriter.noise_ratio:
+            return 0, False
+        return 6, ratios[1] < ratios[0]
+
+    # compressed rows start..stop-1, with their adler32 checksum and length
+    def deflate_block(pixels, start, stop, bpp, level, filters, last):
+        data = PNGWriter.filter_rows(pixels, start, stop, bpp, filters).tobytes()
+        if level > 0 and start > 0:
+            # the end of the previous block (its last rows are filtered again)
+            count = min(start, ceil(32768 / (pixels.shape[1] + 1)))
+            dictionary = PNGWriter.filter_rows(pixels, start - count, start, bpp, filters).tobytes()[-32768:]
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict = dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return compressed, zlib.adler32(data), len(data)
+
+    # adler32 checksum of the concatenation of two buffers (adler32_combine of zlib)
+    def adler32_combine(adler1, adler2, length2):
+        base = PNGWriter.adler_base
+        remainder = length2 % base
+        sum1 = adler1 & 0xffff
+        sum2 = (remainder * sum1) % base
+        sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+        sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - remainder) % base
+        return sum1 | (sum2 << 16)
+
+    def write_chunk(f, kind, data):
+        f.write(len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big"))
+
+    # write the image, with the record (see Metadata) in an iTXt chunk if given
+    def write(im, output, record = None, compression = "auto", verbose = False):
+        bpp = len(im.mode)
+        pixels = np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(im.height, im.width * bpp)
+        level, filters = PNGWriter.settings(pixels, bpp, compression)
+        if verbose:
+            print("PNG compression level:", level, ", filters:", "adaptive" if filters else "none")
+
+        rows = max(1, PNGWriter.block_size // max(1, pixels.shape[1]))
+        blocks = [(start, min(im.height, start + rows)) for start in range(0, im.height, rows)]
+        jobs = max(1, min(PNGWriter.jobs, len(blocks)))
+
+        with contextlib.ExitStack() as stack:
+            f = output
+            if isinstance(output, (str, os.PathLike)):
+                f = stack.enter_context(open(output, "wb"))
+            f.write(b"\x89PNG\r\n\x1a\n")
+            PNGWriter.write_chunk(f, b"IHDR", im.width.to_bytes(4, "big") + im.height.to_bytes(4, "big") +
+                                  bytes([8, PNGWriter.color_types[im.mode], 0, 0, 0]))
+            if record != None:
+                PNGWriter.write_chunk(f, b"iTXt", Metadata.key.encode("latin-1") + b"\0\0\0\0\0" + Metadata.encode(record).encode("utf-8"))
+
+            adler = 1
+            header = bytes([0x78, PNGWriter.zlib_flags[level]])
+            # the blocks are written in order, a few blocks being compressed in advance
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                pending = []
+                def write_block():
+                    nonlocal adler, header
+                    compressed, block_adler, length = pending.pop(0).result()
+                    adler = PNGWriter.adler32_combine(adler, block_adler, length)
+                    if len(pending) == 0 and next_block == len(blocks):
+                        compressed += adler.to_bytes(4, "big")
+                    PNGWriter.write_chunk(f, b"IDAT", header + compressed)
+                    header = b""
+                next_block = 0
+                try:
+                    for start, stop in blocks:
+                        next_block += 1
+                        pending.append(executor.submit(PNGWriter.deflate_block, pixels, start, stop, bpp, level, filters, next_block == len(blocks)))
+                        if len(pending) > 2 * jobs:
+                            write_block()
+                    while len(pending) != 0:
+                        write_block()
+                except:
+                    for future in pending:
+                        future.cancel()
+                    raise
+            PNGWriter.write_chunk(f, b"IEND", b"")
+            if not isinstance(output, (str, os.PathLike)) and hasattr(f, "flush"):
+                f.flush()
+
+
+class ConversionChain:
+    # Sequence of byte-to-byte conversions (see --conversion-chain), composed in a single
+    # 256 entries table applied in one pass (as the conversion methods). Steps:
+    # - the conversion methods: linear, u-law, inverse u-law, a-law, inverse a-law
+    # - bit-reverse: reverse the order of the bits of each byte
+    # - gamma:G: gamma curve on the unsigned bytes (v -> 255 * (v / 255) ^ G)
+    # - map:FILE: custom table, 256 values (0-255) separated by spaces, commas or lines
+    # - table:HEX: custom table, as 512 hexadecimal digits (used for the inverses)
+    #
+    # The inverse chain (stored in history) is computed from the composed table: if it is
+    # a permutation, its exact inverse table. Otherwise, a chain of conversion methods
+    # only is inverted as the methods (the inverse laws in the reverse order, approximate),
+    # and the other chains have no inverse.
+
+    # composed tables, indexed by chain
+    tables = {}
+
+    def step_table(step):
+        name, _, parameter = step.partition(":")
+        values = np.arange(256, dtype=np.uint8)
+        if step in Options.conversion_methods:
+            table = Buffers.conversion_table(step)
+            return values if table is None else table
+        elif step == "bit-reverse":
+            return np.packbits(np.unpackbits(values[:, None], axis=1), axis=1, bitorder="little").reshape(-1)
+        elif name == "gamma":
+            gamma = float(parameter)
+            if gamma <= 0:
+                raise ConversionError("gamma must be positive: " + step)
+            return np.round(255 * (values / 255.0) ** gamma).astype(np.uint8)
+        elif name == "map":
+            with open(parameter) as f:
+                table = [int(v) for v in re.split(r"[\s,;]+", f.read().strip())]
+            if len(table) != 256 or min(table) < 0 or max(table) > 255:
+                raise ConversionError("A map needs 256 values between 0 and 255: " + parameter)
+            return np.array(table, dtype=np.uint8)
+        elif name == "table":
+            if len(parameter) != 512:
+                raise ConversionError("A table needs 512 hexadecimal digits")
+            return np.frombuffer(bytes.fromhex(parameter), dtype=np.uint8)
+        raise ConversionError("Unknown conversion step: " + step)
+
+    # composed table of the steps, None if it is the identity
+    def table(steps):
+        key = tuple(steps)
+        if not key in ConversionChain.tables:
+            table = np.arange(256, dtype=np.uint8)
+            for step in steps:
+                try:
+                    table = ConversionChain.step_table(step)[table]
+                except (OSError, ValueError) as err:
+                    raise ConversionError("Invalid conversion step " + step + ": " + str(err)) from err
+            identity = np.array_equal(table, np.arange(256))
+            ConversionChain.tables[key] = None if identity else table
+        return ConversionChain.tables[key]
+
+    # inverse chain, None if the chain has no inverse
+    def inverse(steps):
+        table = ConversionChain.table(steps)
+        if table is None:
+            return ["linear"]
+        if len(np.unique(table)) == 256:
+            inverse = np.empty(256, dtype=np.uint8)
+            inverse[table] = np.arange(256, dtype=np.uint8)
+            return ["table:" + inverse.tobytes().hex()]
+        if all(step in Options.conversion_methods for step in steps):
+            return [Utils.inverse_conversion_method(step) for step in reversed(steps)]
+        return None
+
+    # short description of the steps (the tables are abbreviated)
+    def describe(steps):
+        return ", ".join(step[:14] + "..." if step.startswith("table:") else step for step in steps)
+
+
+class Periodicity:
+    # Find the dominant periodicities of an audio stream, to choose an image width whose
+    # rows match a period (beats, loops, tones): the same phase is then aligned vertically.
+    #
+    # The autocorrelation is computed with an FFT, on an excerpt of the 8-bits stream
+    # (mixed down to mono), up to the longest period that fits in a row. It is not
+    # decimated: the high frequencies of a click or a tone would alias, and a period that
+    # is not a multiple of the decimation factor would lose its phase.
+    #
+    # The multiples of a period are periods too, with almost the same score: the
+    # fundamental is the first peak whose score is close to the best one.
+
+    # number of frames analyzed, taken in the middle of the stream
+    excerpt_size = 1 << 19
+    # widths larger than this value are ignored
+    max_width = 16384
+    # periods with a lower normalized autocorrelation are ignored
+    min_score = 0.05
+    # the fundamental is the shortest period with a score above this fraction of the best one
+    fundamental_fraction = 0.85
+
+    def mono_excerpt(samples, channels, size):
+        nb_frames = len(samples) // channels
+        start = max(0, (nb_frames - size) // 2)
+        excerpt = np.ascontiguousarray(samples[start * channels:(start + min(size, nb_frames)) * channels])
+        mono = excerpt.view(np.int8).reshape(-1, channels).mean(axis=1, dtype=np.float32)
+        return mono - np.mean(mono)
+
+    # dominant periods (in frames) up to max_period, with a score between 0 and 1. The
+    # fundamental comes first, then the other periods sorted by score
+    def periods(samples, channels, frame_rate, max_period, count = 10):
+        mono = Periodicity.mono_excerpt(samples, channels, Periodicity.excerpt_size)
+        n = len(mono)
+        max_lag = min(n // 2, max_period + 1)
+        if max_lag < 3:
+            return []
+
+        # autocorrelation (biased, i.e. decreasing with the lag, thus the multiples of a
+        # period do not overtake it), normalized by the energy. The FFT is large enough
+        # to avoid the circular wrap up to max_lag
+        fft_size = 1 << int(ceil(np.log2(n + max_lag)))
+        spectrum = np.fft.rfft(mono, fft_size)
+        r = np.fft.irfft(spectrum * np.conj(spectrum), fft_size)[:max_lag + 1]
+        if r[0] <= 0:
+            return []
+        r = r / r[0]
+
+        # local maxima
+        peaks = np.nonzero((r[1:-1] > r[:-2]) & (r[1:-1] >= r[2:]) & (r[1:-1] > 0))[0] + 1
+        peaks = peaks[(peaks >= 2) & (r[peaks] >= Periodicity.min_score)]
+        if len(peaks) == 0:
+            return []
+        fundamental = peaks[np.argmax(r[peaks] >= Periodicity.fundamental_fraction * np.max(r[peaks]))]
+        others = peaks[peaks != fundamental]
+        others = others[np.argsort(r[others])[::-1]][:count - 1]
+        return [(int(lag), float(r[lag])) for lag in [fundamental] + list(others)]
+
+    # candidate widths (width, period in ms, score), sorted by score
+    def width_candidates(au, args, count = 5):
+        samples = Buffers.samples_8bits(au)
+        pixel_channels = 1 if args.greyscale else 4 if args.rgba else 3
+        nb_pixels = len(samples) / pixel_channels
+        target = sqrt(nb_pixels * (args.ratio if args.ratio != None else 1.0))
+
+        candidates = []
+        max_period = Periodicity.max_width * pixel_channels // au.channels
+        for period, score in Periodicity.periods(samples, au.channels, au.frame_rate, max_period):
+            # a row contains an integer number of periods, with a width close to the target
+            row = period * au.channels / pixel_channels
+            if row > Periodicity.max_width:
+                continue
+            width = int(round(max(1, round(target / row)) * row))
+            if width > 0 and not width in [c[0] for c in candidates]:
+                candidates.append((width, 1000 * period / au.frame_rate, score))
+        return candidates[:count]
+
+    def set_auto_width(args, au):
+        candidates = Periodicity.width_candidates(au, args)
+        if len(candidates) == 0:
+            print("No periodicity found, using default ratio")
+            args.width = None
+            args.ratio = 1.0
+            return
+        if args.verbose:
+            for width, period, score in candidates:
+                print("Width candidate: {} px (period: {:.2f} ms, score: {:.2f})".format(width, period, score))
+        args.width = candidates[0][0]
+        args.ratio = None
+        print("Automatic width: {} px (period: {:.2f} ms)".format(args.width, candidates[0][1]))
+
+
+class ExactFit:
+    # Image sizes without missing nor truncated bytes: the width divides the number of
+    # pixels of the stream. The widths are the divisors of this number, enumerated from
+    # its prime factorization (trial division up to its square root, thus instant even
+    # for hour-long recordings), and sorted by distance to the target ratio.
+    #
+    # With an interleaved or segmented stream, each row contains whole audio frames, thus
+    # the channels are at the same place on each row.
+    #
+    # The sizes too far from the ratio (e.g. 1 * n pixels if n is prime) are ignored, as
+    # well as the sides that most formats cannot store (the limit of JPEG).
+    max_ratio_factor = 4
+    max_side = 65535
+
+    # prime factors of n: {prime: exponent}
+    def factorize(n):
+        factors = {}
+        for p in [2, 3]:
+            while n % p == 0:
+                factors[p] = factors.get(p, 0) + 1
+                n //= p
+        # candidates 6k - 1 and 6k + 1
+        p = 5
+        while p * p <= n:
+            for q in [p, p + 2]:
+                while n % q == 0:
+                    factors[q] = factors.get(q, 0) + 1
+                    n //= q
+            p += 6
+        if n > 1:
+            factors[n] = factors.get(n, 0) + 1
+        return factors
+
+    def divisors(n):
+        result = [1]
+        for p, e in ExactFit.factorize(n).items():
+            result = [d * p ** k for d in result for k in range(e + 1)]
+        return sorted(result)
+
+    # number of bytes of the stream converted to pixels (see Rawdodendron.audio_stream),
+    # only using the properties of the audio (Utils.audio_description)
+    def stream_length(au, args):
+        pixel_channels = 1 if args.greyscale else 4 if args.rgba else 3
+        if args.planar == "channels":
+            return int(au.frame_count()) * pixel_channels
+        return int(au.frame_count()) * au.channels
+
+    # exact sizes (width, height), the nearest to the ratio (args.ratio, default 1) first
+    def candidates(au, args, count = 10):
+        pixel_channels = 1 if args.greyscale else 4 if args.rgba else 3
+        length = ExactFit.stream_length(au, args)
+        if length == 0 or length % pixel_channels != 0:
+            return []
+        nb_pixels = length // pixel_channels
+        ratio = args.ratio if args.ratio != None else 1.0
+
+        # number of bytes of the stream in a row (of each plane if segmented)
+        row_bytes = pixel_channels if Planar.is_interleaved(args.planar) else 1
+        sizes = [(w, nb_pixels // w) for w in ExactFit.divisors(nb_pixels)
+                 if args.planar == "channels" or (w * row_bytes) % au.channels == 0]
+        sizes = [(w, h) for w, h in sizes if max(w, h) <= ExactFit.max_side and
+                 abs(log(w / h / ratio)) <= log(ExactFit.max_ratio_factor)]
+        sizes.sort(key=lambda s: abs(log(s[0] / s[1] / ratio)))
+        return sizes[:count]
+
+    def set_width(args, au):
+        candidates = ExactFit.candidates(au, args)
+        if len(candidates) == 0:
+            print("No exact size found, using ratio")
+            return
+        if args.verbose:
+            for width, height in candidates:
+                print("Exact size candidate: {} * {} px (ratio: {:.3f})".format(width, height, width / height))
+        args.width = candidates[0][0]
+        args.ratio = None
+        print("Exact size: {} * {} px".format(candidates[0][0], candidates[0][1]))
+
+
+class Probe:
+    # Dry run: compute the conversion plan of a list of files (output size, duration,
+    # padding or truncation, history match) without converting anything.
+    #
+    # Only the headers are read: images are opened lazily by PIL, PCM WAV files by the wave
+    # module, and other audio formats using ffprobe (through pydub). A file without a
+    # readable header is reported as unknown, it is never decoded (except by --auto-width,
+    # that needs the samples).
+    #
+    # With --frames, frames is the number of frames read (image input) or written (audio
+    # input). The size and the duration are those of each output: the concatenated
+    # frames with concat, a single frame with split.
+    formats = ["json", "csv"]
+    fields = ["file", "input", "output", "width", "height", "mode", "channels", "bitrate",
+              "duration", "frames", "missing", "conversion", "layout", "history", "confidence", "error"]
+
+    # audio properties, as used by Utils.audio_description
+    class AudioHeader:
+        def __init__(self, frame_rate, channels, nb_frames):
+            self.frame_rate = frame_rate
+            self.channels = channels
+            self.nb_frames = nb_frames
+
+        def frame_count(self):
+            return self.nb_frames
+
+    def audio_header(filename):
+        try:
+            with wave.open(filename, "rb") as w:
+                return Probe.AudioHeader(w.getframerate(), w.getnchannels(), w.getnframes())
+        except (wave.Error, EOFError):
+            pass
+        try:
+            info = pydub.utils.mediainfo(filename)
+            frame_rate = int(info["sample_rate"])
+            header = Probe.AudioHeader(frame_rate, int(info["channels"]), int(round(float(info["duration"]) * frame_rate)))
+            header.conversion_record = Metadata.read_tags(info.get("TAG", {}))
+            return header
+        except (OSError, KeyError, ValueError, TypeError) as err:
+            # no header information available (or no ffprobe)
+            raise ConversionError("Unknown file format: no image nor audio header found") from err
+
+    def open(filename, args):
+        try:
+            return Image.open(filename)
+        except (OSError, ValueError):
+            pass
+        if args.auto_width:
+            # the samples are required to detect the periodicities
+            au = PCMCache.decode(filename)
+        else:
+            au = Probe.audio_header(filename)
+        if not hasattr(au, "conversion_record"):
+            au.conversion_record = Metadata.read_audio(filename)
+        return au
+
+    def plan(filename, args, history):
+        args = copy(args)
+        entry = {"file": filename}
+        source = Probe.open(filename, args)
+
+        if isinstance(source, Image.Image):
+            data = history.consolidate_parameters_from_image(args, source)
+            channels = 1 if args.mono else 2
+            frames = Utils.nb_frames(source) if args.frames in ["concat", "split"] else 1
+            mode = Rawdodendron.frames_mode(source) if args.frames == "concat" and frames > 1 else source.mode
+            size = Utils.pixels_size(mode, source.width, source.height)
+            if args.planar == "channels":
+                # one frame per pixel
+                size = source.width * source.height * channels
+            if args.frames == "concat":
+                size *= frames
+            final_size = size
+            if final_size % channels != 0:
+                final_size += -1 if args.truncate else 1
+            entry.update({"input": "image", "output": "audio", "width": source.width, "height": source.height,
+                          "mode": mode, "channels": channels, "bitrate": args.bitrate,
+                          "duration": final_size / channels / args.bitrate, "frames": frames, "missing": final_size - size})
+        else:
+            data = history.consolidate_parameters_from_audio(args, source)
+            mode = "L" if args.greyscale else "RGBA" if args.rgba else "RGB"
+            length = Utils.audio_description(source)["a_size"]
+            if args.planar == "channels":
+                # one pixel per frame
+                length = length // source.channels * len(mode)
+            if args.frames in ["concat", "split"]:
+                # as in save_as_frames
+                width, height = Video.frame_geometry(args, source.frame_rate, source.channels)
+                frame_size = Utils.pixels_size(mode, width, height)
+                frames = max(1, length // frame_size if args.truncate else ceil(length / frame_size))
+                missing = frames * frame_size - length
+            else:
+                width, height, missing = Rawdodendron.get_image_size_from_length(length, args)
+                frames = 1
+            entry.update({"input": "audio", "output": "image", "width": width, "height": height, "mode": mode,
+                          "channels": source.channels, "bitrate": source.frame_rate,
+                          "duration": source.frame_count() / source.frame_rate, "frames": frames, "missing": missing})
+
+        entry["conversion"] = Utils.conversion_method(args) if args.conversion_chain == None else ConversionChain.describe(args.conversion_chain)
+        entry["layout"] = args.layout
+        entry["history"] = data != None
+        entry["confidence"] = None if data == None else data.get("confidence", 1.0)
+        return entry
+
+    def run(args):
+        history = History()
+        plan = []
+        # messages (e.g. from history) are written on stderr, the plan on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            for filename in args.probe:
+                try:
+                    plan.append(Probe.plan(filename, args, history))
+                except Exception as e:
+                    plan.append({"file": filename, "error": str(e)})
+                    if args.verbose:
+                        print("Error while reading", filename, ":", e)
+
+        if args.probe_format == "csv":
+            writer = csv.DictWriter(sys.stdout, fieldnames=Probe.fields)
+            writer.writeheader()
+            writer.writerows(plan)
+        else:
+            json.dump(plan, sys.stdout, indent=1)
+            print("")
+
+
+class Manifest:
+    # Conversions described in a manifest, with per-file parameters. A JSON manifest is a
+    # list of items, a CSV manifest has a column per field:
+    #
+    #   [{"input": "a.wav", "output": "a.png", "width": 300, "mode": "L"},
+    #    {"input": "b.png", "bitrate": 48000, "channels": 1, "conversion": "u-law"}]
+    #
+    # The fields are the Options of the library API. Missing parameters are guessed from
+    # history (unless --ignore-history is used), and an item without output is written
+    # next to its input (see --batch-extension). Relative paths are relative to the
+    # manifest. In CSV files, the effects and filters are separated by ";".
+    #
+    # The items are converted by a pool of processes, the largest inputs first. Each
+    # completed item is appended to the checkpoint file (FILE.checkpoint), and skipped by
+    # the next runs if its output still exists. A report gives the duration of each item.
+    fields = {"width": int, "ratio": float, "auto_width": bool, "exact_fit": bool, "mode": str, "channels": int, "bitrate": int,
+              "conversion": str, "conversion_chain": list, "truncate": bool, "layout": str, "planar": str, "frames": str,
+              "png_compression": str, "audio_effects": list, "image_filters": list}
+    report_fields = ["index", "input", "output", "status", "size", "seconds", "error"]
+
+    def parse_value(kind, value):
+        if kind == bool and isinstance(value, str):
+            return value.strip().lower() in ["1", "true", "yes"]
+        if kind == list and isinstance(value, str):
+            return [v.strip() for v in value.split(";") if v.strip() != ""]
+        return kind(value)
+
+    # list of items, with parsed values and resolved paths
+    def load(filename):
+        with open(filename, newline="") as f:
+            if filename.lower().endswith(".csv"):
+                rows = list(csv.DictReader(f))
+            else:
+                rows = json.load(f)
+        directory = os.path.dirname(os.path.abspath(filename))
+
+        items = []
+        for i, row in enumerate(rows):
+            unknown = [k for k in row if not k in Manifest.fields and not k in ["input", "output"]]
+            if len(unknown) != 0:
+                raise ConversionError("Unknown field in item " + str(i + 1) + " of the manifest: " + ", ".join(unknown))
+            if row.get("input") in [None, ""]:
+                raise ConversionError("Missing input in item " + str(i + 1) + " of the manifest")
+            item = {"input": os.path.join(directory, row["input"]), "output": None}
+            if not row.get("output") in [None, ""]:
+                item["output"] = os.path.join(directory, row["output"])
+            for key, kind in Manifest.fields.items():
+                if not row.get(key) in [None, ""]:
+                    item[key] = Manifest.parse_value(kind, row[key])
+            items.append(item)
+        return items
+
+    # identify an item in the checkpoint (a modified item is converted again)
+    def key(item):
+        return hashlib.blake2b(json.dumps(item, sort_keys=True).encode("utf-8"), digest_size=12).hexdigest()
+
+    # results of the completed items, by key
+    def load_checkpoint(filename):
+        done = {}
+        try:
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                        done[result["key"]] = result
+                    except (ValueError, KeyError):
+                        # a line may be incomplete if the previous run was killed
+                        pass
+        except OSError:
+            pass
+        return done
+
+    def item_args(item, use_history, verbose):
+        options = {k: item[k] for k in Manifest.fields if k in item}
+        return Options(use_history = use_history, verbose = verbose, **options).to_args()
+
+    def init_worker(decode_jobs, png_jobs):
+        # Ctrl-C is handled by the main process, that lets the running items finish
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # the messages of the conversions go to stderr, line by line, so that they are
+        # not mixed with the progress of the manifest, printed on stdout
+        sys.stdout = sys.stderr
+        SegmentedDecoder.jobs = decode_jobs
+        PNGWriter.jobs = png_jobs
+
+    # convert an item (in a worker process). The history records are returned, to be
+    # stored by the main process
+    def run_item(job):
+        start = time.monotonic()
+        result = {"key": job["key"], "index": job["index"], "input": job["item"]["input"], "output": job["output"], "size": job["size"]}
+        try:
+            args = Manifest.item_args(job["item"], job["use_history"], job["verbose"])
+            args.output = open(job["output"], "w")
+            args.output.close()
+            input_file = Rawdodendron.load_input_file(job["item"]["input"], args.verbose)
+            records = []
+            if isinstance(input_file, Image.Image):
+                if Utils.is_image_filename(job["output"]):
+                    Rawdodendron.bend_image(input_file, args)
+                else:
+                    records = Rawdodendron.save_as_audio(input_file, args, True, False)
+                input_file.close()
+            elif Utils.is_image_filename(job["output"]):
+                records = Rawdodendron.save_as_image(input_file, args, True, False)
+            else:
+                Rawdodendron.bend_audio(input_file, args)
+            result["status"] = "done"
+            result["records"] = records
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+            if os.path.exists(job["output"]):
+                os.remove(job["output"])
+        result["seconds"] = round(time.monotonic() - start, 3)
+        return result
+
+    def write_report(filename, results):
+        results = sorted(results, key=lambda r: r["index"])
+        with open(filename, "w", newline="") as f:
+            if filename.lower().endswith(".csv"):
+                writer = csv.DictWriter(f, fieldnames=Manifest.report_fields, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(results)
+            else:
+                json.dump([{k: r[k] for k in Manifest.report_fields if k in r} for r in results], f, indent=1)
+
+    def run(args):
+        try:
+            items = Manifest.load(args.manifest)
+        except (OSError, ValueError, ConversionError) as err:
+            print("\nError while reading the manifest:", err, "\n", file=sys.stderr)
+            exit(1)
+        checkpoint = args.manifest + ".checkpoint"
+        report = args.manifest_report if args.manifest_report != None else args.manifest + ".report.json"
+        done = Manifest.load_checkpoint(checkpoint)
+
+        # skip the completed items
+        results = []
+        jobs = []
+        for index, item in enumerate(items):
+            key = Manifest.key(item)
+            if key in done and os.path.exists(done[key]["output"]):
+                results.append(dict(done[key], index=index + 1, status="resumed"))
+                continue
+            try:
+                size = os.path.getsize(item["input"])
+            except OSError as err:
+                print("Error:", err, file=sys.stderr)
+                results.append({"key": key, "index": index + 1, "input": item["input"], "output": item["output"], "status": "error", "error": str(err)})
+                continue
+            jobs.append({"key": key, "index": index + 1, "item": item, "output": item["output"], "size": size,
+                         "use_history": not args.ignore_history, "verbose": args.verbose})
+
+        # largest first, so that the last running items are the small ones
+        jobs.sort(key=lambda job: -job["size"])
+        names = OutputNames()
+        for job in jobs:
+            if job["output"] == None:
+                f = names.allocate(job["item"]["input"], Rawdodendron.batch_extension(job["item"]["input"], args.batch_extension))
+                f.close()
+                job["output"] = f.name
+        print(len(results), "item(s) already done or invalid,", len(jobs), "item(s) to convert using", args.jobs, "process(es)")
+
+        # the first Ctrl-C cancels the items that are not started yet
+        progress = Progress()
+        def interrupt(signum, frame):
+            progress.cancel()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        handler = signal.signal(signal.SIGINT, interrupt)
+
+        history = History()
+        nb_done = 0
+        # the processors are shared by the items decoded by segments (see SegmentedDecoder)
+        decode_jobs = max(1, SegmentedDecoder.jobs // max(1, args.jobs))
+        png_jobs = max(1, PNGWriter.jobs // max(1, args.jobs))
+        try:
+            with open(checkpoint, "a") as checkpoint_file, ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=Manifest.init_worker, initargs=(decode_jobs, png_jobs)) as executor:
+                futures = {executor.submit(Manifest.run_item, job): job for job in jobs}
+                remaining = set(futures)
+                while len(remaining) != 0:
+                    finished, remaining = wait(remaining, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        job = futures[future]
+                        if future.cancelled():
+                            results.append({"key": job["key"], "index": job["index"], "input": job["item"]["input"], "output": job["output"], "size": job["size"], "status": "cancelled"})
+                            # remove the reserved output
+                            if job["item"]["output"] == None and os.path.exists(job["output"]) and os.path.getsize(job["output"]) == 0:
+                                os.remove(job["output"])
+                            continue
+                        result = future.result()
+                        nb_done += 1
+                        if result["status"] == "done":
+                            for record in result.pop("records"):
+                                history.store_params_to_history(record)
+                            checkpoint_file.write(json.dumps(result) + "\n")
+                            checkpoint_file.flush()
+                            print("[" + str(nb_done) + "/" + str(len(jobs)) + "]", result["input"], "->", result["output"], "(" + str(result["seconds"]) + " s)")
+                        else:
+                            print("[" + str(nb_done) + "/" + str(len(jobs)) + "]", "Error while converting", result["input"], ":", result["error"], file=sys.stderr)
+                        results.append(result)
+                    if progress.cancelled:
+                        for future in remaining:
+                            future.cancel()
+        finally:
+            signal.signal(signal.SIGINT, handler)
+            Manifest.write_report(report, results)
+            print("Report written in", report)
+
+        if progress.cancelled:
+            print("\nManifest interrupted, run it again to resume\n", file=sys.stderr)
+            exit(Progress.exit_code)
+        if any(r["status"] == "error" for r in results):
+            exit(2)
 
 
 class Rawdodendron:
 
-    # main class that convert an image to an audio file, or an audio file to an image
-    def load_input_file(filename, verbose):
+    # the PIL encoders keep their state in the image (encoderinfo, copy of a read-only
+    # image), thus an image shared by several outputs is saved by one thread at a time
+    save_lock = threading.Lock()
+
+    # main class that convert an image to an audio file, or an audio file to an image
+    # the progress (if any) reports the decoding of the audio files, and the reading of
+    # the image files (decoded later, when the pixels are used)
+    def load_input_file(filename, verbose, progress = None):
         try:
             # try to load the input as an audio file
-            au = AudioSegment.from_file(filename)
+            au = PCMCache.decode(filename, verbose, progress)
+            # the record is already known if the file has been probed by the decoder
+            if not hasattr(au, "conversion_record"):
+                au.conversion_record = Metadata.read_audio(filename)
 
             if verbose:
                 print("Audio properties: ", "channels:", au.channels, ", sample_width:", au.sample_width, ", frame_rate", au.frame_rate, ", duration:", au.duration_seconds, "s")
 
             return au
+        except Cancelled:
+            raise
         except: 
             # if the file is not an audio file, try to load it as an image
-            im = Image.open(filename)
+            if hasattr(filename, "seek"):
+                filename.seek(0)
+            if progress != None and isinstance(filename, (str, os.PathLike)):
+                f = open(filename, "rb")
+                try:
+                    im = Image.open(Progress.File(f, progress, "decode", os.path.getsize(filename)))
+                except Image.UnidentifiedImageError:
+                    # PIL names the file object in its message, not the file
+                    f.close()
+                    raise Image.UnidentifiedImageError("cannot identify image file " + repr(str(filename)))
+            else:
+                im = Image.open(filename)
             if verbose:
                 print("Image size:", str(im.width) + "px",  "*", str(im.height) + "px", ", mode:", im.mode)
 
@@ -285,16 +2960,75 @@ class Rawdodendron:
 
 
     def convert(args):
+        # progress line on a terminal, and cancellation using Ctrl-C (a second Ctrl-C
+        # interrupts the script immediately)
+        args.progress = Progress(Progress.terminal if sys.stderr.isatty() else None)
+        def interrupt(signum, frame):
+            args.progress.cancel()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        handler = signal.signal(signal.SIGINT, interrupt)
+
+        try:
+            # when the data is written on the standard output, messages go to stderr
+            if any(Utils.is_stdout(o) for o in Rawdodendron.outputs(args)):
+                with contextlib.redirect_stdout(sys.stderr):
+                    Rawdodendron.convert_input(args)
+            else:
+                Rawdodendron.convert_input(args)
+        except Cancelled:
+            Progress.terminal_end()
+            print("\nConversion cancelled, partial outputs removed\n", file=sys.stderr)
+            Rawdodendron.remove_outputs(args)
+            exit(Progress.exit_code)
+        finally:
+            Progress.terminal_end()
+            signal.signal(signal.SIGINT, handler)
+
+    def convert_input(args):
         print("Input file: ", args.input.name)
-        print("Output file: ", args.output.name)
+        for name in Rawdodendron.output_names(args):
+            print("Output file: ", name)
+
+        if Video.is_video_output(args):
+            if args.extra_outputs:
+                print("\nError: a single output is supported for videos\n", file=sys.stderr)
+                exit(1)
+            try:
+                Video.save_as_video(args)
+            except Cancelled:
+                raise
+            except Exception as e:
+                print("\nError while writing video:", e, "\n", file=sys.stderr)
+                exit(2)
+            return
+
+        if args.output_format == "pgm" and not Parameters.has_image_mode_parameter(args):
+            args.greyscale = True
+
+        try:
+            kinds = set(Streams.is_image_output(o, args) for o in Rawdodendron.outputs(args))
+        except ConversionError as e:
+            print("\nError:", e, "\n", file=sys.stderr)
+            exit(1)
+        if len(kinds) != 1:
+            print("\nError: all the outputs must be images, or all the outputs must be audio files\n", file=sys.stderr)
+            exit(1)
 
         try:
-            input_file = Rawdodendron.load_input_file(args.input.name, args.verbose)
+            if Utils.is_stdin(args.input):
+                input_file = Streams.load(Streams.stdin(), args)
+            else:
+                input_file = Rawdodendron.load_input_file(args.input.name, args.verbose, args.progress)
+        except Cancelled:
+            raise
+        except ConversionError as err:
+            print("\nError:", err, "\n", file=sys.stderr)
+            exit(1)
         except TypeError as err:
             print("\nError while reading image:", err, "\n")
             parser.print_help()
             
-            if verbose:
+            if args.verbose:
                 print("\nError: ", sys.exc_info()[0])
             
             exit(1)
@@ -302,16 +3036,30 @@ class Rawdodendron:
             print("\nError: unknown input format", err, "\n")
             parser.print_help()
             
-            if verbose:
+            if args.verbose:
                 print("\nError: ", sys.exc_info()[0])            
             exit(1)
 
         if input_file == None:
             exit(2)
-        elif isinstance(input_file, Image.Image):
+
+        try:
+            Utils.check_effects(args, isinstance(input_file, Image.Image))
+        except ConversionError as err:
+            print("\nError:", err, "\n", file=sys.stderr)
+            Rawdodendron.remove_outputs(args)
+            exit(1)
+
+        if isinstance(input_file, Image.Image):
             try:
-                # try to convert the image file as an audio file
-                Rawdodendron.save_as_audio(input_file, args)
+                if Streams.is_image_output(args.output, args):
+                    # apply audio effects on the image
+                    Rawdodendron.bend_image(input_file, args)
+                else:
+                    # try to convert the image file as an audio file
+                    Rawdodendron.save_as_audio(input_file, args)
+            except Cancelled:
+                raise
             except Exception as e:
                 print("\nError while writing audio file:", e, "\n")
                 exit(2)
@@ -322,9 +3070,15 @@ class Rawdodendron:
 
         elif isinstance(input_file, AudioSegment):
             try:
-                # try to convert the audio file as an image
-                Rawdodendron.save_as_image(input_file, args)
+                if Streams.is_image_output(args.output, args):
+                    # try to convert the audio file as an image
+                    Rawdodendron.save_as_image(input_file, args)
+                else:
+                    # apply image filters on the audio file
+                    Rawdodendron.bend_audio(input_file, args)
                 
+            except Cancelled:
+                raise
             except Exception as e:
                 print("\nError while writing image file", e, "\n")
                 exit(2)
@@ -336,37 +3090,189 @@ class Rawdodendron:
             exit(1)
 
 
-    def save_as_audio(im, args, use_history = True):
+    # extension of the output of a file converted in batch
+    def batch_extension(filename, extension):
+        if extension == None:
+            extension = "wav" if Utils.is_image_filename(filename) else "png"
+        if not extension.startswith("."):
+            extension = "." + extension
+        return extension
+
+    # convert each file of args.batch, with an output next to it. The output names are
+    # allocated once for the whole batch
+    def convert_batch(args):
+        names = OutputNames()
+        failures = 0
+        for filename in args.batch:
+            file_args = copy(args)
+            file_args.batch = None
+            extension = Rawdodendron.batch_extension(filename, args.batch_extension)
+            try:
+                file_args.input = open(filename)
+            except OSError as err:
+                print("\nError:", err, "\n")
+                failures += 1
+                continue
+            file_args.output = names.allocate(filename, extension)
+            file_args.output.close()
+            try:
+                Rawdodendron.convert(file_args)
+            except SystemExit as err:
+                if err.code:
+                    failures += 1
+                    # remove the empty reserved file
+                    if os.path.exists(file_args.output.name) and os.path.getsize(file_args.output.name) == 0:
+                        os.remove(file_args.output.name)
+                # stop the batch if a conversion has been cancelled
+                if err.code == Progress.exit_code:
+                    raise
+            finally:
+                file_args.input.close()
+        if failures > 0:
+            print(failures, "file(s) not converted")
+            exit(2)
+
+    # requested outputs (-o can be repeated)
+    def outputs(args):
+        return [args.output] + (args.extra_outputs or [])
+
+    # names of the outputs (of the current frame if args.frame is set)
+    def output_names(args):
+        return [Utils.frame_name(o.name, args.frame) for o in Rawdodendron.outputs(args)]
+
+    # where to export each output: a filename, or the binary standard output
+    def output_targets(args):
+        return [Streams.stdout() if Utils.is_stdout(o) else Utils.frame_name(o.name, args.frame) for o in Rawdodendron.outputs(args)]
+
+    # remove the output files (after a cancellation)
+    def remove_outputs(args):
+        for target in Rawdodendron.output_targets(args):
+            if isinstance(target, (str, os.PathLike)) and os.path.exists(target):
+                os.remove(target)
+
+    # call export(target) for each output. The outputs share the converted data, and are
+    # encoded concurrently (the encoders release the GIL, or run in an ffmpeg process),
+    # except the images saved by PIL (see save_lock).
+    # If the conversion is cancelled, the partial outputs are removed
+    def export_all(args, export):
+        targets = Rawdodendron.output_targets(args)
+        try:
+            if len(targets) == 1:
+                return [export(targets[0])]
+            with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                return list(executor.map(export, targets))
+        except Cancelled:
+            Rawdodendron.remove_outputs(args)
+            raise
+
+    def image_to_audio(im, args, use_history = True):
 
         # consolidate parameters using history
         if use_history:
             history = History()
             history.consolidate_parameters_from_image(args, im)
 
-        # get data
-        data = im.tobytes()
-        # get information about the output (number of channels)
+        # get data, in the order given by the layout
+        if args.frames == "concat" and Utils.nb_frames(im) > 1:
+            data = Rawdodendron.frames_bytes(im, args)
+        else:
+            data = Rawdodendron.image_bytes(im, args)
+        return Rawdodendron.bytes_to_audio(data, args)
+
+    # mode of the frames of a concat conversion. The frames after the first one can
+    # use another mode (e.g. RGB after a palette in GIF files), thus palettes are
+    # converted to RGB (or RGBA if there is a transparency)
+    def frames_mode(im):
+        if im.mode in ["RGB", "RGBA"] or (im.mode == "L" and im.format != "GIF"):
+            return im.mode
+        return "RGBA" if "A" in im.getbands() or "transparency" in im.info else "RGB"
+
+    # raw data of all the frames of an image, in a single buffer. The frames are decoded
+    # one at a time (as the image is seeked), each one in the order given by the layout
+    def frames_bytes(im, args):
+        mode = Rawdodendron.frames_mode(im)
+        size = im.size
+        frame_size = Utils.pixels_size(mode, im.width, im.height)
+        buffer = memoryview(bytearray(frame_size * Utils.nb_frames(im)))
+        if args.verbose:
+            print("Frames:", Utils.nb_frames(im), ", mode:", mode)
+
+        for i, frame in enumerate(ImageSequence.Iterator(im)):
+            if frame.size != size:
+                raise ConversionError("All the frames must have the same size to be concatenated")
+            if frame.mode != mode:
+                frame = frame.convert(mode)
+            part = buffer[i * frame_size:(i + 1) * frame_size]
+            if Layouts.is_raster(args.layout) and Planar.is_interleaved(args.planar):
+                Buffers.image_bytes(frame, frame_size, None, args.progress, part)
+            else:
+                Buffers.fill(Buffers.array(part), Buffers.array(Rawdodendron.image_bytes(frame, args)), None)
+        im.seek(0)
+        return buffer
+
+    # the raw data of an image, in the order given by the layout. In raster order, the
+    # image itself is returned, and encoded later in the final buffer (see Buffers.build)
+    def image_bytes(im, args):
+        if Layouts.is_raster(args.layout) and Planar.is_interleaved(args.planar):
+            return im
+        data = Buffers.image_bytes(im, Utils.image_size(im), None, args.progress)
+        return Rawdodendron.pixels_to_stream(data, im.width, im.height, len(data) // (im.width * im.height), args)
+
+    # raw pixels (raster order) to the stream of bytes, following the layout and the
+    # planar mapping
+    def pixels_to_stream(data, width, height, channels, args):
+        if not Layouts.is_raster(args.layout):
+            if args.verbose:
+                print("Layout: " + args.layout)
+            data = Layouts.to_stream(data, width, height, channels, args.layout)
+        if args.planar == "segments":
+            data = Planar.deinterleave(data, channels)
+        elif args.planar == "channels":
+            data = Planar.pixels_to_audio(data, channels, 1 if args.mono else 2)
+        return data
+
+    # 8-bits samples of an audio file, as the stream of bytes converted to pixels
+    def audio_stream(au, args):
+        data = Buffers.samples_8bits(au)
+        if args.planar == "channels":
+            data = Planar.audio_to_pixels(data, au.channels, 1 if args.greyscale else 4 if args.rgba else 3)
+        return data
+
+    # convert raw bytes (e.g. the pixels of an image) to 8-bits samples.
+    # data can be any bytes-like object (or an image), it is not copied if no
+    # transformation is required
+    def bytes_to_samples(data, args):
+        # get information about the output (number of channels)
         channels =  1 if args.mono else 2
 
         if args.verbose:
             print("")
             
-        # apply a byte-to-byte conversion if required
-        data = Rawdodendron.apply_conversion(data, args)
-    
         # handle extra bytes (truncate or add missing data)
-        if len(data) % (channels) != 0:
+        final_size = Buffers.length(data)
+        if final_size % (channels) != 0:
             if args.truncate:
                 if args.verbose:
                     print("Truncate data")
-                data = data[:-1]
+                final_size -= 1
             else:
                 if args.verbose:
                     print("Add missing bytes at the end of binary data")
-                data = data + b"\x00"
+                final_size += 1
 
-        # create the audio structure
-        au = AudioSegment(
+        # apply a byte-to-byte conversion if required, in a single buffer
+        data = Buffers.build(data, final_size, Rawdodendron.conversion_table(args), args.progress, args.in_place)
+
+        # apply audio effects if required
+        data = AudioEffects.apply(data, channels, args.bitrate, args.audio_effect, args.verbose)
+
+        return data, channels
+
+    def bytes_to_audio(data, args):
+        data, channels = Rawdodendron.bytes_to_samples(data, args)
+
+        # create the audio structure
+        return AudioSegment(
             # raw audio data (bytes)
             data = data,
 
@@ -380,166 +3286,714 @@ class Rawdodendron:
             channels = channels
         )
 
+    # returns the history records of the outputs
+    def save_as_audio(im, args, use_history = True, store_history = True):
+        args.produced = None
+        Utils.check_effects(args, True)
+        if args.frames == "split" and Utils.nb_frames(im) > 1:
+            return Rawdodendron.save_frames_as_audio(im, args, use_history, store_history)
+
+        au = Rawdodendron.image_to_audio(im, args, use_history)
+
+        frames = Utils.nb_frames(im) if args.frames == "concat" else 1
+        record = History.record(au, im, True, args, frames)
+        Rawdodendron.export_all(args, lambda target: Rawdodendron.export_audio(au, target, args, record = record))
+
+        # store input and output properties in the history (once, as the outputs share
+        # the same audio)
+        count = len(Rawdodendron.output_names(args))
+        Rawdodendron.keep_produced(args, [au] * count, [record] * count)
+        if store_history:
+            History().store_params_to_history(dict(record))
+        return [record]
+
+    # an audio output per frame (name-0001.wav...), the frames being decoded one at a time
+    def save_frames_as_audio(im, args, use_history = True, store_history = True):
+        Rawdodendron.check_frame_outputs(args)
+        records = []
+        for i, frame in enumerate(ImageSequence.Iterator(im)):
+            frame_args = copy(args)
+            frame_args.frames = "first"
+            frame_args.frame = i + 1
+            if args.verbose:
+                print("Frame", i + 1, "/", Utils.nb_frames(im))
+            records += Rawdodendron.save_as_audio(frame, frame_args, use_history, store_history)
+        im.seek(0)
+        Rawdodendron.remove_empty_outputs(args)
+        return records
+
+    def check_frame_outputs(args):
+        if any(Utils.is_stdout(o) for o in Rawdodendron.outputs(args)):
+            raise ConversionError("An output per frame cannot be written on the standard output")
+
+    # remove the outputs created by the command line but not used (see --frames split)
+    def remove_empty_outputs(args):
+        for name in Rawdodendron.output_names(args):
+            if os.path.exists(name) and os.path.getsize(name) == 0:
+                os.remove(name)
+
+    # output can be a filename or a file object (in this case, the format is required).
+    # The record (see Metadata) is embedded in the file if given
+    def export_audio(au, output, args, format = None, record = None):
+        name = output if isinstance(output, (str, os.PathLike)) else getattr(output, "name", None)
         if args.verbose:
-            print("Export data: " + args.output.name)
+            print("Export data: " + str(name))
+
+        if Utils.is_stdout(output):
+            # streamed in chunks, without embedded record (the header cannot be rewritten)
+            if args.progress != None:
+                output = Progress.File(output, args.progress, "encode", len(au.raw_data))
+            Streams.write_audio(au, output, format if format != None else Streams.output_format(args))
+            return
 
         # try to guess format using extension
-        filename, file_extension = os.path.splitext(args.output.name)
-        format = file_extension.lower()[1:]
+        if format == None:
+            if not isinstance(name, (str, os.PathLike)):
+                raise ConversionError("Unable to guess the output format")
+            filename, file_extension = os.path.splitext(name)
+            format = file_extension.lower()[1:]
         if format == "wave":
             format = "wav"
 
-        # save file
-        file_handle = au.export(args.output.name, format=format)
-
-        # store input and output properties in the history
-        history = History()
-        history.store_parameters(au, im, True, Utils.conversion_method(args))
+        if args.progress != None and format in ["wav", "raw"]:
+            # written in chunks to report the progress
+            f = open(output, "wb") if isinstance(output, (str, os.PathLike)) else output
+            try:
+                Streams.write_audio(au, Progress.File(f, args.progress, "encode", len(au.raw_data)), format)
+                if record != None and format == "wav":
+                    Metadata.append_wav_chunk(f, record)
+            finally:
+                if f is not output:
+                    f.close()
+            return
+
+        if not format in ["wav", "raw"] and isinstance(output, (str, os.PathLike)):
+            # encoded by ffmpeg, without temporary files
+            FFmpeg.encode(au, output, format, Metadata.audio_parameters(record, format).get("tags"), args.progress)
+            return
+
+        # save file (the other formats are encoded at once by ffmpeg)
+        Progress.report(args.progress, "encode", 0, len(au.raw_data))
+        file_handle = au.export(output, format=format, **Metadata.audio_parameters(record, format))
+        Progress.report(args.progress, "encode", len(au.raw_data), len(au.raw_data))
+        if record != None and format == "wav":
+            Metadata.append_wav_chunk(file_handle, record)
+        if file_handle is not output:
+            file_handle.close()
+
+    # apply audio effects on an image, without writing the intermediate audio file
+    def bend_image(im, args, use_history = True):
+        Utils.check_effects(args, True)
+        if not im.mode in ["L", "RGB", "RGBA"]:
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+
+        au = Rawdodendron.image_to_audio(im, args, use_history)
+
+        # convert back the samples using the geometry of the input image
+        back_args = copy(args)
+        back_args.width = im.width
+        back_args.ratio = None
+        back_args.greyscale = im.mode == "L"
+        back_args.rgb = im.mode == "RGB"
+        back_args.rgba = im.mode == "RGBA"
+        Utils.set_inverse_conversion(back_args, args)
+        # keep the initial height if the effects did not change the number of samples
+        back_args.truncate = len(au.raw_data) >= Utils.image_size(im)
+        back_args.add_extra_bytes = not back_args.truncate
+        back_args.audio_effect = None
+
+        Rawdodendron.save_as_image(au, back_args, False, False)
 
     # get the image size from the parameters
     def get_image_size(data, args):
-        # it depends on the number of bytes per pixel
+        return Rawdodendron.get_image_size_from_length(len(data), args)
+
+    # get the image size from the parameters and the number of bytes
+    def get_image_size_from_length(length, args):
+        # it depends on the number of bytes per pixel
         channels = 1 if args.greyscale else 4 if args.rgba else 3
 
         # if a size is given, we use it
         if args.width != None:
             width = args.width
 
-            height = len(data) / width / channels
+            height = length / width / channels
             height = ceil(height)
         else:
-            # otherwise we use the given ratio
-            nb_pixels = ceil(len(data) / channels)
+            # otherwise we use the given ratio
+            nb_pixels = ceil(length / channels)
             # args.ratio = width / height
             # nb_pixels = width * height (if no pixel is missing)
-            # thus
+            # thus
             width = ceil(sqrt(nb_pixels * args.ratio))
             height = ceil(width / args.ratio)
 
-        # estimate the number of missing pixels
-        missing = width * height * channels - len(data)
+        # estimate the number of missing pixels
+        missing = width * height * channels - length
 
         # if truncate is required, update the information
         if missing > 0 and args.truncate:
             missing = missing - width * channels
             height = height - 1
 
-        # return the computed image size, and the number of missing pixels (can be negative if the data has to be truncated)
+        # return the computed image size, and the number of missing pixels (can be negative if the data has to be truncated)
         return width, height, missing
 
 
-    def apply_conversion(data, args):
-        if args.conversion_u_law:
+    def conversion_table(args):
+        if args.conversion_chain != None:
             if args.verbose:
-                print("Conversion using u-law")
-            data = audioop.lin2ulaw(data, 1)
-        elif args.conversion_a_law:
-            if args.verbose:
-                print("Conversion using a-law")
-            data = audioop.lin2alaw(data, 1)
-        elif args.conversion_inverse_u_law:
-            if args.verbose:
-                print("Conversion using inverse u-law")
-            data = audioop.ulaw2lin(data, 1)
-        elif args.conversion_inverse_a_law:
-            if args.verbose:
-                print("Conversion using inverse a-law")
-            data = audioop.alaw2lin(data, 1)
-        return data
+                print("Conversion using the chain: " + ConversionChain.describe(args.conversion_chain))
+            return ConversionChain.table(args.conversion_chain)
+        method = Utils.conversion_method(args)
+        if method != "linear" and args.verbose:
+            print("Conversion using " + method)
+        return Buffers.conversion_table(method)
 
-    def save_as_image(au, args, use_history = True):
+    def apply_conversion(data, args):
+        table = Rawdodendron.conversion_table(args)
+        if table is None:
+            return data
+        return Buffers.build(data, len(data), table)
 
-        # convert to 8-bits
-        au = au.set_sample_width(1)
+    def audio_to_image(au, args, use_history = True):
 
         # load history
         if use_history:
             history = History()
             history.consolidate_parameters_from_audio(args, au)
 
-        # get data from the audio
-        data = au.raw_data
+        # get data from the audio (8-bits samples, without intermediate copy)
+        im, missing = Rawdodendron.bytes_to_image(Rawdodendron.audio_stream(au, args), args)
+        return au, im, missing
 
+    # convert raw bytes (e.g. 8-bits audio samples) to the pixels of an image.
+    # data can be any bytes-like object, it is not copied if no transformation is required
+    def bytes_to_pixels(data, args):
         if args.verbose:
             print("")
 
-        # apply a byte-to-byte conversion if required
-        data = Rawdodendron.apply_conversion(data, args)
-
-        # compute image size
+        # compute image size
         width, height, missing = Rawdodendron.get_image_size(data, args)
 
-        # add missing pixels with an 00 value
+        # add missing pixels with an 00 value
         if missing > 0:
             if args.verbose:
                 print("Add missing bytes at the end of binary data")
-            data = data + b"\x00" * missing
         # if required, truncate data
         elif missing < 0:
             if args.verbose:
                 print("Truncate data")
-            data = data[:missing]
+
+        # apply a byte-to-byte conversion if required, in a single buffer
+        data = Buffers.build(data, len(data) + missing, Rawdodendron.conversion_table(args), args.progress, args.in_place)
 
         # compute the target mode (greyscae, RGB, RGBA)
         mode = "L" if args.greyscale else "RGBA" if args.rgba else "RGB"
         if args.verbose:
             print("Mode: " + mode)
 
-        # create the image
-        im = Image.frombytes(mode, (width, height), data, "raw", mode, 0, 1)
+        # split the stream in color planes
+        if args.planar == "segments":
+            data = Planar.interleave(data, len(mode))
+
+        # place the pixels following the layout
+        if not Layouts.is_raster(args.layout):
+            if args.verbose:
+                print("Layout: " + args.layout)
+            data = Layouts.from_stream(data, width, height, len(mode), args.layout)
+
+        # apply image filters if required
+        data, width, height = ImageFilters.apply(data, width, height, len(mode), args.image_filter, args.verbose)
+
+        return data, width, height, mode, missing
+
+    def bytes_to_image(data, args):
+        data, width, height, mode, missing = Rawdodendron.bytes_to_pixels(data, args)
+
+        # create the image (sharing the buffer when the mode allows it)
+        return Image.frombuffer(mode, (width, height), data, "raw", mode, 0, 1), missing
+
+    # returns the history records of the outputs
+    def save_as_image(au, args, use_history = True, store_history = True):
+        args.produced = None
+        Utils.check_effects(args, False)
+
+        if use_history:
+            History().consolidate_parameters_from_audio(args, au)
+        if args.frames in ["concat", "split"]:
+            return Rawdodendron.save_as_frames(au, args, store_history)
+
+        au, im, missing = Rawdodendron.audio_to_image(au, args, False)
+
+        record = History.record(au, im, False, args)
+        images = Rawdodendron.export_all(args, lambda target: Rawdodendron.export_image(im, target, args, record = record))
 
+        # finaly, store the configuration in the history logs (once per output, as the
+        # saved image can be different, e.g. without alpha channel)
+        records = [History.record(au, saved, False, args) for saved in images]
+        Rawdodendron.keep_produced(args, images, records)
+        if store_history:
+            history = History()
+            for r in records:
+                history.store_params_to_history(r)
+        return records
+
+    # keep the written audio segments or images in args.produced (output name -> object),
+    # with the record embedded in the file, so that an output can be used as an input
+    # without decoding it again (see RawWindow.Input.inverse)
+    def keep_produced(args, objects, records):
+        args.produced = {}
+        for name, obj, record in zip(Rawdodendron.output_names(args), objects, records):
+            if isinstance(obj, AudioSegment):
+                obj.conversion_record = dict(record)
+            else:
+                obj.info[Metadata.key] = Metadata.encode(record)
+            args.produced[name] = obj
+
+    # frames start..count-1, created by frame(i) each time the sequence is iterated (the
+    # PNG encoder iterates twice)
+    class Frames:
+        def __init__(self, frame, start, count):
+            self.frame = frame
+            self.start = start
+            self.count = count
+
+        def __iter__(self):
+            return (self.frame(i) for i in range(self.start, self.count))
+
+    # convert an audio file to frames of --width * --frame-height pixels (or of the
+    # duration given by --frame-duration, as the videos), written as a multi-frame
+    # image (concat), or as an image per frame (split).
+    # The frames are images sharing the converted buffer when the mode allows it
+    # (L, RGBA), and are created when the encoder asks for them. Some encoders (TIFF,
+    # WebP, APNG) build the list of the frames before writing them.
+    def save_as_frames(au, args, store_history = True):
+        mode = "L" if args.greyscale else "RGBA" if args.rgba else "RGB"
+        width, height = Video.frame_geometry(args, au.frame_rate, au.channels)
+        frame_size = Utils.pixels_size(mode, width, height)
+
+        data = Rawdodendron.audio_stream(au, args)
+        count = len(data) // frame_size if args.truncate else ceil(len(data) / frame_size)
+        count = max(1, count)
+        # convert the whole stream, missing bytes being zeros
+        data = Buffers.build(data, count * frame_size, Rawdodendron.conversion_table(args), args.progress)
+        print("Frames:", count, ",", width, "*", height, "pixels, mode:", mode)
+
+        # each frame is converted as a single image, from the converted bytes
+        frame_args = copy(args)
+        frame_args.width = width
+        frame_args.ratio = None
+        frame_args.auto_width = False
+        frame_args.verbose = False
+        frame_args.progress = None
+        Utils.set_conversion_method(frame_args, "linear")
+        def frame(i):
+            Progress.report(args.progress, "encode", i, count)
+            pixels, w, h, m, missing = Rawdodendron.bytes_to_pixels(data[i * frame_size:(i + 1) * frame_size], frame_args)
+            return Image.frombuffer(m, (w, h), pixels, "raw", m, 0, 1)
+
+        if args.frames == "split":
+            Rawdodendron.check_frame_outputs(args)
+            # the frames are parts of the audio file, they are not recorded
+            for i in range(count):
+                im = frame(i)
+                frame_args.frame = i + 1
+                Rawdodendron.export_all(frame_args, lambda target: Rawdodendron.export_image(im, target, args))
+            Rawdodendron.remove_empty_outputs(args)
+            return []
+
+        for o in Rawdodendron.outputs(args):
+            if not Utils.supports_frames("-." + Streams.output_format(args) if Utils.is_stdout(o) else o.name):
+                raise ConversionError("The format of " + o.name + " does not support several frames, use --frames split")
+        first = frame(0)
+        record = History.record(au, first, False, args, count)
+        others = Rawdodendron.Frames(frame, 1, count)
+        images = Rawdodendron.export_all(args, lambda target: Rawdodendron.export_image(first, target, args, record = record, append_images = others))
+
+        records = [History.record(au, saved, False, args, count) for saved in images]
+        if store_history:
+            history = History()
+            for r in records:
+                history.store_params_to_history(r)
+        return records
+
+    # output can be a filename or a file object (in this case, the format is required).
+    # The record (see Metadata) is embedded in the file if given. The other frames of a
+    # multi-frame image are given by append_images (an iterable).
+    # Returns the image that has been saved (the first frame).
+    def export_image(im, output, args, format = None, record = None, append_images = None):
         if args.verbose:
-            print("Export data: " + args.output.name)
+            print("Export data: " + str(output if isinstance(output, (str, os.PathLike)) else getattr(output, "name", "")))
+        if format == None and Utils.is_stdout(output):
+            format = Streams.image_formats[Streams.output_format(args)]
+        if args.progress != None and not isinstance(output, Progress.File):
+            # the encoders write by blocks, the size of the output being unknown
+            if isinstance(output, (str, os.PathLike)):
+                # readable, as the multi-page TIFF encoder reads back the written pages
+                with open(output, "w+b") as f:
+                    return Rawdodendron.export_image(im, Progress.File(f, args.progress, "encode"), args, format, record, append_images)
+            output = Progress.File(output, args.progress, "encode")
+        parameters = Metadata.image_parameters(record)
+        if append_images != None:
+            parameters.update(save_all = True, append_images = append_images)
 
         try:
-            # try to save the image
-            im.save(args.output.name)
-            # finaly, store the configuration in the history logs
-            history = History()
-            history.store_parameters(au, im, False, Utils.conversion_method(args))
+            # try to save the image
+            if PNGWriter.supports(im, output, format, args, append_images):
+                PNGWriter.write(im, output, record, args.png_compression, args.verbose)
+            else:
+                with Rawdodendron.save_lock:
+                    im.save(output, format, **parameters)
+        except Cancelled:
+            raise
         except Exception as err:
-            # if an exception occured, the selected format may not support alpha channels (e.g. jpg)
-            if mode == "RGBA":
-                # we try to convert the image in RGB format
+            # if an exception occured, the selected format may not support alpha channels (e.g. jpg)
+            if im.mode == "RGBA" and append_images == None:
+                # we try to convert the image in RGB format
                 if args.verbose:
                     print("Force RGB mode")
-                im = im.convert("RGB")
+                with Rawdodendron.save_lock:
+                    im = im.convert("RGB")
+                if record != None:
+                    record = dict(record, **Utils.image_description(im))
+
+                # and try to save again the image
+                if hasattr(output, "seekable") and output.seekable():
+                    output.seek(0)
+                    output.truncate()
+                im.save(output, format, **Metadata.image_parameters(record))
+            else:
+                raise ConversionError("Error while saving image: " + str(err)) from err
+        return im
+
+    # apply image filters on an audio file, without writing the intermediate image file
+    def bend_audio(au, args, use_history = True):
+        Utils.check_effects(args, False)
+        # the filters are applied below, moving the mask of the bytes added to fill the
+        # image with the pixels (e.g. by a flip)
+        filters = args.image_filter
+        args = copy(args)
+        args.image_filter = None
+        au, im, missing = Rawdodendron.audio_to_image(au, args, use_history)
+        channels = len(im.mode)
+        pixels = np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(im.height, im.width, channels)
+
+        mask = None
+        if missing > 0:
+            mask = np.zeros(pixels.size, dtype=np.uint8)
+            mask[-missing:] = 1
+            if args.planar == "segments":
+                mask = Planar.interleave(mask, channels)
+            mask = np.frombuffer(Layouts.from_stream(mask, im.width, im.height, channels, args.layout), dtype=np.uint8).reshape(pixels.shape)
+        if filters:
+            pixels, mask = ImageFilters.apply_pixels(pixels, filters, args.verbose, mask)
+        height, width = pixels.shape[:2]
+
+        # convert back the pixels using the properties of the input audio file
+        back_args = copy(args)
+        back_args.mono = au.channels == 1
+        back_args.stereo = au.channels == 2
+        Utils.set_inverse_conversion(back_args, args)
+        data = Rawdodendron.pixels_to_stream(np.ascontiguousarray(pixels).tobytes(), width, height, channels, back_args)
+
+        # remove the bytes that were added to fill the image
+        if mask is not None:
+            back_args.verbose = False
+            padding = Rawdodendron.pixels_to_stream(np.ascontiguousarray(mask).tobytes(), width, height, channels, back_args)
+            data = Buffers.array(data)[Buffers.array(padding) == 0].tobytes()
+
+        data = Rawdodendron.apply_conversion(data, back_args)
+        data = data[:len(data) - len(data) % au.channels]
+
+        result = AudioSegment(data = data, sample_width = 1, frame_rate = au.frame_rate, channels = au.channels)
+        Rawdodendron.export_all(args, lambda target: Rawdodendron.export_audio(result, target, args))
+
+
+class Options:
+    # Typed options of the library API (see Converter), independent of argparse.
+    #
+    # A None value means that the parameter is guessed from history if use_history is set,
+    # or set to its default value otherwise.
+    #
+    # - width (int) or ratio (float): size of the generated images
+    # - auto_width (bool): choose a width that matches a periodicity of the audio
+    # - exact_fit (bool): choose a size without missing bytes, near the ratio (see ExactFit)
+    # - mode ("L", "RGB" or "RGBA"): pixel mode of the generated images
+    # - channels (1 or 2) and bitrate (int, in Hz): properties of the generated audio
+    # - conversion: "linear", "u-law", "inverse u-law", "a-law" or "inverse a-law"
+    # - conversion_chain (list of strings): sequence of conversions (see ConversionChain),
+    #   instead of conversion
+    # - truncate (bool): truncate data rather than adding empty elements
+    # - audio_effects, image_filters (lists of strings): see AudioEffects and ImageFilters
+    # - layout: order of the pixels in the image (see Layouts)
+    # - planar: mapping between the audio and the color planes (see Planar)
+    # - frames ("first" or "concat"): conversion of the images with several frames by
+    #   image_to_audio (split is only used by the command line and the manifests)
+    # - png_compression: compression of the PNG outputs (see PNGWriter)
+    # - in_place (bool): convert the bytes-like inputs in their own buffer when possible,
+    #   rather than in a new buffer (the input is overwritten)
+    # - progress: a Progress, to follow and cancel the conversions
+    modes = {"L": "greyscale", "RGB": "rgb", "RGBA": "rgba"}
+    conversion_methods = ["linear", "u-law", "inverse u-law", "a-law", "inverse a-law"]
+    frame_conversions = ["first", "concat", "split"]
+
+    def __init__(self, width = None, ratio = None, auto_width = False, exact_fit = False, mode = None, channels = None, bitrate = None,
+                 conversion = None, truncate = None, audio_effects = None, image_filters = None,
+                 layout = None, planar = None, frames = None, use_history = False, verbose = False, progress = None,
+                 conversion_chain = None, png_compression = None, in_place = False):
+        self.width = width
+        self.ratio = ratio
+        self.auto_width = auto_width
+        self.exact_fit = exact_fit
+        self.mode = mode
+        self.channels = channels
+        self.bitrate = bitrate
+        self.conversion = conversion
+        self.conversion_chain = conversion_chain
+        self.truncate = truncate
+        self.audio_effects = audio_effects
+        self.image_filters = image_filters
+        self.layout = layout
+        self.planar = planar
+        self.frames = frames
+        self.use_history = use_history
+        self.verbose = verbose
+        self.progress = progress
+        self.png_compression = png_compression
+        self.in_place = in_place
+
+    # build the structure used by the conversion core
+    def to_args(self):
+        args = Parameters.default_args()
+
+        if self.width != None and self.ratio != None:
+            raise ConversionError("width and ratio cannot be both given")
+        if self.width != None:
+            if int(self.width) <= 0:
+                raise ConversionError("width must be positive")
+            args.width = int(self.width)
+        if self.ratio != None:
+            if float(self.ratio) <= 0:
+                raise ConversionError("ratio must be positive")
+            args.ratio = float(self.ratio)
+        args.auto_width = bool(self.auto_width)
+        args.exact_fit = bool(self.exact_fit)
+        args.in_place = bool(self.in_place)
+
+        if self.mode != None:
+            if not self.mode in Options.modes:
+                raise ConversionError("Unknown pixel mode: " + str(self.mode))
+            args.greyscale = self.mode == "L"
+            args.rgb = self.mode == "RGB"
+            args.rgba = self.mode == "RGBA"
+
+        if self.channels != None:
+            if not self.channels in [1, 2]:
+                raise ConversionError("Number of channels must be 1 or 2")
+            args.mono = self.channels == 1
+            args.stereo = self.channels == 2
+
+        if self.bitrate != None:
+            if int(self.bitrate) <= 0:
+                raise ConversionError("bitrate must be positive")
+            args.bitrate = int(self.bitrate)
+
+        if self.conversion != None:
+            if not self.conversion in Options.conversion_methods:
+                raise ConversionError("Unknown conversion method: " + str(self.conversion))
+            Utils.set_conversion_method(args, self.conversion)
+        if self.conversion_chain != None:
+            if self.conversion != None:
+                raise ConversionError("conversion and conversion_chain cannot be both given")
+            ConversionChain.table(self.conversion_chain)
+            Utils.set_conversion_method(args, "linear")
+            args.conversion_chain = list(self.conversion_chain)
+
+        if self.png_compression != None:
+            if not self.png_compression in PNGWriter.compressions:
+                raise ConversionError("Unknown PNG compression: " + str(self.png_compression))
+            args.png_compression = self.png_compression
+
+        if self.truncate != None:
+            args.truncate = bool(self.truncate)
+            args.add_extra_bytes = not args.truncate
+
+        if self.layout != None:
+            if not self.layout in Layouts.names:
+                raise ConversionError("Unknown layout: " + str(self.layout))
+            args.layout = self.layout
+
+        if self.planar != None:
+            if not self.planar in Planar.names:
+                raise ConversionError("Unknown planar mapping: " + str(self.planar))
+            args.planar = self.planar
+
+        if self.frames != None:
+            if not self.frames in Options.frame_conversions:
+                raise ConversionError("Unknown frames conversion: " + str(self.frames))
+            args.frames = self.frames
+
+        args.audio_effect = list(self.audio_effects) if self.audio_effects else None
+        args.image_filter = list(self.image_filters) if self.image_filters else None
+        for spec in args.audio_effect or []:
+            Utils.parse_effect(spec, AudioEffects.effects, "audio effect")
+        for spec in args.image_filter or []:
+            Utils.parse_effect(spec, ImageFilters.filters, "image filter")
+        args.ignore_history = not self.use_history
+        args.verbose = self.verbose
+        args.progress = self.progress
+        return args
+
+
+class Converter:
+    # Library API, to embed the conversions in another program without spawning the CLI.
+    #
+    # Inputs can be a PIL image or an AudioSegment, a path, a file object (decoded using
+    # its content), or any bytes-like object (bytes, bytearray, memoryview, numpy array)
+    # that is used as the raw payload (pixels or 8-bits samples) without being copied. A
+    # conversion is written in a new buffer, unless the in_place option is set.
+    # Outputs can be written to a path or a file object. Errors raise exceptions, and a
+    # cancelled conversion (see Options.progress) raises Cancelled after removing the
+    # partial output file.
+    #
+    # converter = Converter(Options(width = 300, mode = "RGB"))
+    # im = converter.audio_to_image("audio.wav", "image.png")
+
+    def __init__(self, options = None):
+        self.options = options if options != None else Options()
+
+    def load(self, source):
+        if isinstance(source, (Image.Image, AudioSegment)):
+            return source
+        if isinstance(source, (str, os.PathLike)) or hasattr(source, "read"):
+            try:
+                return Rawdodendron.load_input_file(source, self.options.verbose, self.options.progress)
+            except Cancelled:
+                raise
+            except Exception as err:
+                raise ConversionError("Unknown input format: " + str(err)) from err
+        try:
+            return memoryview(source).cast("B")
+        except TypeError as err:
+            raise ConversionError("Unsupported input type: " + type(source).__name__) from err
 
-                # and try to save again the image
-                im.save(args.output.name)
+    # raw pixels are reordered using the layout and the planar mapping, the geometry being
+    # given by the width and pixel mode options
+    def buffer_stream(self, data, args):
+        if Layouts.is_raster(args.layout) and Planar.is_interleaved(args.planar):
+            return data
+        if args.width == None:
+            raise ConversionError("The width is required to use a layout or a planar mapping on raw pixels")
+        channels = 1 if args.greyscale else 4 if args.rgba else 3
+        return Rawdodendron.pixels_to_stream(data, args.width, len(data) // (args.width * channels), channels, args)
 
-                # finaly, store the configuration in the history logs
-                history = History()
-                history.store_parameters(au, im, False, Utils.conversion_method(args))
-            else:
-                print("\nError:", err, "\n")
-                exit(2)
+    # run export(), removing the partial output file if the conversion is cancelled
+    def export(self, export, output):
+        try:
+            return export()
+        except Cancelled:
+            if isinstance(output, (str, os.PathLike)) and os.path.exists(output):
+                os.remove(output)
+            raise
+
+    def image_to_audio(self, image, output = None, format = None):
+        args = self.options.to_args()
+        Utils.check_effects(args, True)
+        source = self.load(image)
+        if isinstance(source, AudioSegment):
+            raise ConversionError("The input is not an image")
+
+        history = History()
+        if isinstance(source, Image.Image):
+            history.consolidate_parameters_from_image(args, source)
+            if args.frames == "split":
+                raise ConversionError("The frames can only be concatenated by the library")
+            au = Rawdodendron.image_to_audio(source, args, False)
+        else:
+            history.consolidate_parameters_from_image(args, None)
+            au = Rawdodendron.bytes_to_audio(self.buffer_stream(source, args), args)
+
+        if output != None:
+            frames = Utils.nb_frames(source) if args.frames == "concat" else 1
+            record = History.record(au, source, True, args, frames) if isinstance(source, Image.Image) else None
+            self.export(lambda: Rawdodendron.export_audio(au, output, args, format, record), output)
+            if self.options.use_history and isinstance(source, Image.Image):
+                history.store_params_to_history(dict(record))
+        return au
+
+    def audio_to_image(self, audio, output = None, format = None):
+        args = self.options.to_args()
+        Utils.check_effects(args, False)
+        source = self.load(audio)
+        if isinstance(source, Image.Image):
+            raise ConversionError("The input is not an audio file")
+
+        history = History()
+        if isinstance(source, AudioSegment):
+            au = source
+            history.consolidate_parameters_from_audio(args, au)
+            im, missing = Rawdodendron.bytes_to_image(Rawdodendron.audio_stream(au, args), args)
+        else:
+            history.consolidate_parameters_from_audio(args, None)
+            im, missing = Rawdodendron.bytes_to_image(source, args)
+
+        if output != None:
+            record = History.record(au, im, False, args) if isinstance(source, AudioSegment) else None
+            im = self.export(lambda: Rawdodendron.export_image(im, output, args, format, record), output)
+            if self.options.use_history and isinstance(source, AudioSegment):
+                history.store_parameters(au, im, False, args)
+        return im
+
+    # raw 8-bits samples as a (frames, channels) int8 array
+    def image_to_samples(self, image):
+        args = self.options.to_args()
+        Utils.check_effects(args, True)
+        source = self.load(image)
+        if isinstance(source, AudioSegment):
+            raise ConversionError("The input is not an image")
+        if isinstance(source, Image.Image):
+            History().consolidate_parameters_from_image(args, source)
+            source = Rawdodendron.image_bytes(source, args)
+        else:
+            History().consolidate_parameters_from_image(args, None)
+            source = self.buffer_stream(source, args)
+        data, channels = Rawdodendron.bytes_to_samples(source, args)
+        return np.frombuffer(data, dtype=np.int8).reshape(-1, channels)
+
+    # raw pixels as a (height, width, channels) uint8 array
+    def audio_to_pixels(self, audio):
+        args = self.options.to_args()
+        Utils.check_effects(args, False)
+        source = self.load(audio)
+        if isinstance(source, Image.Image):
+            raise ConversionError("The input is not an audio file")
+        if isinstance(source, AudioSegment):
+            History().consolidate_parameters_from_audio(args, source)
+            source = Rawdodendron.audio_stream(source, args)
+        else:
+            History().consolidate_parameters_from_audio(args, None)
+        data, width, height, mode, missing = Rawdodendron.bytes_to_pixels(source, args)
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, len(mode))
 
 
 class RawWindow(QMainWindow):
 
     history = History()
+    output_names = OutputNames()
         
     class Input:
         counter = 0
 
+        # formats giving back the written data when they are decoded (the inverted inputs
+        # use the converted data instead of reading the output file)
+        lossless_extensions = [".wav", ".flac", ".png", ".bmp", ".tif", ".tiff"]
+
         class OutputDescription:
             def __init__(self, input_name, extension):
-                path = pathlib.Path(input_name)
-                parent = str(path.parent)
-                stem = str(path.stem)
-                m = re.search('(.*) \(([0-9]+?)\)$', stem)
-                if m:
-                    found = m.group(2)
-                    i = int(found)
-                    stem = m.group(1)
-                    self.name = parent + "/" + stem + " (" + str(i) + ")" + extension
-                else:
-                    self.name = parent + "/" + stem + extension
-                    i = 0
-                while os.path.exists(self.name):
-                    i += 1
-                    self.name = parent + "/" + stem + " (" + str(i) + ")" + extension
+                self.name = RawWindow.output_names.propose(input_name, extension)
+                # automatic names are created on disk just before the conversion
+                self.allocated = True
                 print(self.name)
 
         def __init__(self, filename, args):
@@ -549,6 +4003,9 @@ class RawWindow(QMainWindow):
             self.id = RawWindow.Input.counter
             RawWindow.Input.counter += 1
 
+            # width candidates (see Periodicity), computed on demand for each pixel mode
+            self.width_candidates = {}
+
             self.load_input_file()
 
         def set_parameter(self, key, value):
@@ -558,6 +4015,12 @@ class RawWindow(QMainWindow):
             elif key == "missing-bytes":
                 self.set_missing_bytes_method(value)
                 return True
+            elif key == "layout":
+                self.set_layout(value)
+                return True
+            elif key == "planar":
+                self.set_planar(value)
+                return True
             elif key == "pixel-mode":
                 if not self.is_image:
                     self.set_pixel_mode(value)
@@ -593,17 +4056,34 @@ class RawWindow(QMainWindow):
         def set_missing_bytes_method(self, method):
             self.args.truncate = method == "truncate"
             self.args.add_extra_bytes = method == "add-extra-bytes"
+            self.invalidate_size()
         
         def get_conversion_method(self):
             return Utils.conversion_method(self.args)
 
         def set_conversion_method(self, method):
+            # a chain is only given by the command line or history
+            if method != "chain":
+                self.args.conversion_chain = None
             self.args.conversion_linear = method == "linear"
             self.args.conversion_u_law = method == "inverse u-law"
             self.args.conversion_inverse_u_law = method == "u-law"
             self.args.conversion_a_law = method == "inverse a-law"
             self.args.conversion_inverse_a_law = method == "a-law"
 
+        def get_layout(self):
+            return self.args.layout
+
+        def set_layout(self, layout):
+            self.args.layout = layout
+
+        def get_planar(self):
+            return self.args.planar
+
+        def set_planar(self, planar):
+            self.args.planar = planar
+            self.invalidate_size()
+
         def get_bitrate(self):
             return self.args.bitrate
 
@@ -619,20 +4099,21 @@ class RawWindow(QMainWindow):
         def set_channels(self, channels):
             self.args.mono = channels == "mono"
             self.args.stereo = channels == "stereo"
+            self.invalidate_size()
 
         def get_ratio_size(self):
             return self.args.ratio
 
         def set_ratio_value(self, value):
-            self.args.ratio = float(value.replace(",", "."))
-            self.update_size()
+            self.args.ratio = float(str(value).replace(",", "."))
+            self.invalidate_size()
 
         def get_width_size(self):
             return self.args.width
 
         def set_width_value(self, value):
             self.args.width = int(value)
-            self.update_size()
+            self.invalidate_size()
 
         def get_size_mode(self):
             if self.args.width:
@@ -641,10 +4122,24 @@ class RawWindow(QMainWindow):
                 return "ratio"
         
         def set_size_mode(self, mode):            
+            self.update_size()
             self.args.ratio = self.width / self.height if mode == "ratio" else None
             self.args.width = self.width if mode == "width" else None
-            self.update_size()
+            self.invalidate_size()
             
+        def get_width_candidates(self):
+            mode = self.get_pixel_mode()
+            if not mode in self.width_candidates:
+                self.width_candidates[mode] = Periodicity.width_candidates(self.input_file, self.args)
+            return self.width_candidates[mode]
+
+        # sizes without missing bytes (see ExactFit), the nearest to the current ratio first
+        def get_exact_sizes(self):
+            self.update_size()
+            args = copy(self.args)
+            args.ratio = self.width / self.height
+            return ExactFit.candidates(self.input_file, args)
+
         def get_pixel_mode(self):
             if self.args.greyscale:
                 return "greyscale"
@@ -659,14 +4154,17 @@ class RawWindow(QMainWindow):
             self.args.greyscale = mode == "greyscale"
             self.args.rgb = mode == "rgb"
             self.args.rgba = mode == "rgba"
-            self.update_size()
+            self.invalidate_size()
 
         # reload the input file and identify if it changed or not
         def file_properties_changed(self):
+            # the data of a previous conversion is used until the file is modified
+            if self.file_stat != None and self.file_stat == RawWindow.Input.stat(self.filename):
+                return False
+            self.file_stat = None
             try:
                 new_input_file = Rawdodendron.load_input_file(self.filename, self.args.verbose)
             
-                self.update_size()
                 desc = Utils.description(self.input_file)
                 new_desc = Utils.description(new_input_file)
                 if desc == new_desc:
@@ -677,31 +4175,60 @@ class RawWindow(QMainWindow):
             except:
                 return True
 
-        def get_data(self):
+        # number of bytes of the 8-bits stream (pixels or samples), computed once per
+        # loaded file without encoding it
+        def update_length(self):
             if self.is_image:
-                return self.input_file.tobytes()
+                self.length = Utils.image_size(self.input_file)
+                self.nb_elements = self.input_file.width * self.input_file.height
             else:
-                return self.input_file.raw_data
+                self.length = Utils.audio_description(self.input_file)["a_size"]
+                self.nb_elements = int(self.input_file.frame_count())
+            self.invalidate_size()
+
+        # the parameters changed: the size of the output will be computed when displayed
+        def invalidate_size(self):
+            self.size_changed = True
 
         def update_size(self):
+            if not self.size_changed:
+                return
+            self.size_changed = False
             if self.is_image:
+                channels = 1 if self.get_channels() == "mono" else 2
                 self.width = None
-                self.heigh = None
+                self.height = None
                 self.missing = None
-                self.final_size = len(self.input_file.tobytes())
-                if self.final_size % (2 if self.get_channels() == "stero" else 1) != 0:
+                # one frame per pixel with a planar mapping of the channels
+                self.final_size = self.nb_elements * channels if self.args.planar == "channels" else self.length
+                if self.final_size % channels != 0:
                     if self.args.truncate:
                         self.final_size -= 1
                     else:
                         self.final_size += 1
             else:
-                self.width, self.height, self.missing = Rawdodendron.get_image_size(self.get_data(), self.args)
-                self.final_size = len(self.input_file.raw_data) + self.missing
+                # one pixel per frame with a planar mapping of the channels
+                pixel_channels = 1 if self.args.greyscale else 4 if self.args.rgba else 3
+                length = self.nb_elements * pixel_channels if self.args.planar == "channels" else self.length
+                self.width, self.height, self.missing = Rawdodendron.get_image_size_from_length(length, self.args)
+                self.final_size = length + self.missing
+
+        # modification time and size of a file, or None if it cannot be read
+        def stat(filename):
+            try:
+                st = os.stat(filename)
+                return (st.st_mtime_ns, st.st_size)
+            except OSError:
+                return None
 
-        def load_input_file(self):
+        # load the input file, or use the given data (an AudioSegment or an Image) if it
+        # is the content of the file
+        def load_input_file(self, data = None):
             self.is_valid = False
+            # state of the file when the data has been given (see file_properties_changed)
+            self.file_stat = RawWindow.Input.stat(self.filename) if data != None else None
             try:
-                self.input_file = Rawdodendron.load_input_file(self.filename, self.args.verbose)
+                self.input_file = data if data != None else Rawdodendron.load_input_file(self.filename, self.args.verbose)
                 self.is_valid = self.input_file != None
 
                 if self.is_valid:
@@ -710,7 +4237,7 @@ class RawWindow(QMainWindow):
                             print("Loading image:", self.filename)
                         self.is_image = True
                         RawWindow.history.consolidate_parameters_from_image(self.args, self.input_file)
-                        self.update_size()
+                        self.update_length()
                         # set output name
                         self.computeNextPossibleOutputName()
                     elif isinstance(self.input_file, AudioSegment):
@@ -718,7 +4245,7 @@ class RawWindow(QMainWindow):
                             print("Loading audio:", self.filename)
                         self.is_image = False
                         RawWindow.history.consolidate_parameters_from_audio(self.args, self.input_file)
-                        self.update_size()
+                        self.update_length()
                         # set output name
                         self.computeNextPossibleOutputName()
                         
@@ -743,15 +4270,40 @@ class RawWindow(QMainWindow):
 
         def set_output_file(self, filename):
             self.args.output.name = filename
-
+            self.args.output.allocated = False
+
+        # create the output file, choosing the next name if it has been created in between
+        # (a name chosen by the user is kept)
+        def reserve_output(self):
+            if not self.args.output.allocated:
+                return
+            f = RawWindow.output_names.reserve(self.args.output.name)
+            if f == None:
+                f = RawWindow.output_names.allocate(self.args.output.name, pathlib.Path(self.args.output.name).suffix)
+                self.args.output.name = f.name
+            f.close()
+
+        # use the output of the last conversion as input. The converted data is used
+        # directly if the output format is lossless, otherwise the file is decoded
         def inverse(self):
+            data = None
+            if self.args.produced != None and pathlib.Path(self.args.output.name).suffix.lower() in RawWindow.Input.lossless_extensions:
+                data = self.args.produced.get(self.args.output.name)
+                # the alpha channel of BMP files is not read back
+                if isinstance(data, Image.Image) and data.mode == "RGBA" and pathlib.Path(self.args.output.name).suffix.lower() == ".bmp":
+                    data = None
             self.filename = self.args.output.name
             self.args.output = None
-            self.load_input_file()
+            self.args.produced = None
+            self.width_candidates = {}
+            if data != None and self.args.verbose:
+                print("Use the converted data of", self.filename)
+            self.load_input_file(data)
 
         def get_size_info(self):
+            self.update_size()
             if self.is_image:
-                return self.final_size / self.args.bitrate
+                return self.final_size / (1 if self.get_channels() == "mono" else 2) / self.args.bitrate
             else:
                 return (self.width, self.height)
                 
@@ -912,7 +4464,8 @@ class RawWindow(QMainWindow):
                                         ("u-law", "u-law"),
                                         ("inverse u-law", "u-law inverse"),
                                         ("a-law", "a-law"),
-                                        ("inverse a-law", "a-law inverse")
+                                        ("inverse a-law", "a-law inverse"),
+                                        ("chain", "chaîne de conversions")
                                         ]
             for i in self.conversion_values:
                 self.conversion.addItem(i[1])
@@ -938,6 +4491,40 @@ class RawWindow(QMainWindow):
             self.missingBytesToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all("missing-bytes", self.current.get_missing_bytes_method(), self.current.id))
             gridCommonPanel.addWidget(self.missingBytesToAll, 3, 5, 1, 2)
 
+            title = QLabel()
+            title.setText("Parcours des pixels:")
+            gridCommonPanel.addWidget(title, 4, 0)
+            self.pixelLayout = QComboBox()
+            self.pixelLayout_values = [ ("raster", "ligne par ligne"),
+                                   ("serpentine", "serpentin"),
+                                   ("column", "colonne par colonne"),
+                                   ("hilbert", "courbe de Hilbert"),
+                                   ("zorder", "courbe en Z")]
+            for i in self.pixelLayout_values:
+                self.pixelLayout.addItem(i[1])
+            self.pixelLayout.currentIndexChanged.connect(self.onUpdateLayout)
+            gridCommonPanel.addWidget(self.pixelLayout, 4, 1, 1, 4)
+            self.pixelLayoutToAll = QPushButton()
+            self.pixelLayoutToAll.setText("Copier à tous")
+            self.pixelLayoutToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all("layout", self.current.get_layout(), self.current.id))
+            gridCommonPanel.addWidget(self.pixelLayoutToAll, 4, 5, 1, 2)
+
+            title = QLabel()
+            title.setText("Plans de couleur:")
+            gridCommonPanel.addWidget(title, 5, 0)
+            self.planar = QComboBox()
+            self.planar_values = [ ("interleaved", "entrelacés"),
+                                   ("channels", "un canal audio par plan"),
+                                   ("segments", "segments successifs")]
+            for i in self.planar_values:
+                self.planar.addItem(i[1])
+            self.planar.currentIndexChanged.connect(self.onUpdatePlanar)
+            gridCommonPanel.addWidget(self.planar, 5, 1, 1, 4)
+            self.planarToAll = QPushButton()
+            self.planarToAll.setText("Copier à tous")
+            self.planarToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all("planar", self.current.get_planar(), self.current.id))
+            gridCommonPanel.addWidget(self.planarToAll, 5, 5, 1, 2)
+
 
             # create the image panel
             self.imagePanel = QGroupBox("Propriétés de l'image cible")
@@ -974,15 +4561,36 @@ class RawWindow(QMainWindow):
             gridImagePanel.addWidget(self.sizeMode, 1, 1, 1, 2)
             self.sizeValue = QLineEdit()
             self.sizeValue.editingFinished.connect(self.onUpdateSizeValue)
+            # while typing, the size is updated after a short delay
+            self.sizeValueTimer = QTimer(self)
+            self.sizeValueTimer.setSingleShot(True)
+            self.sizeValueTimer.setInterval(300)
+            self.sizeValueTimer.timeout.connect(self.onUpdateSizeValue)
+            self.sizeValue.textEdited.connect(self.sizeValueTimer.start)
             gridImagePanel.addWidget(self.sizeValue, 1, 3, 1, 2)
             self.sizeModeToAll = QPushButton()
             self.sizeModeToAll.setText("Copier à tous")
-            if self.sizeMode_values[self.sizeMode.currentIndex()][0] == "ratio":
-                self.sizeModeToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all("ratio", self.current.get_ratio_size(), self.current.id))
-            else:
-                self.sizeModeToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all("width", self.current.get_width_size(), self.current.id))
+            self.sizeModeToAll.clicked.connect(lambda x: rawWindow.on_set_parameter_to_all(self.current.get_size_mode(),
+                                                self.current.get_width_size() if self.current.get_size_mode() == "width" else self.current.get_ratio_size(),
+                                                self.current.id))
             gridImagePanel.addWidget(self.sizeModeToAll, 1, 5, 1, 2)
 
+            title = QLabel()
+            title.setText("Largeurs suggérées:")
+            gridImagePanel.addWidget(title, 2, 0)
+            self.widthCandidates = QComboBox()
+            self.widthCandidates.setToolTip("Largeurs correspondant aux périodicités du son (rythme, boucle, note)")
+            self.widthCandidates.activated.connect(self.onSelectWidthCandidate)
+            gridImagePanel.addWidget(self.widthCandidates, 2, 1, 1, 4)
+
+            title = QLabel()
+            title.setText("Tailles exactes:")
+            gridImagePanel.addWidget(title, 3, 0)
+            self.exactSizes = QComboBox()
+            self.exactSizes.setToolTip("Tailles remplies exactement par le son, sans octets ajoutés ni tronqués")
+            self.exactSizes.activated.connect(self.onSelectExactSize)
+            gridImagePanel.addWidget(self.exactSizes, 3, 1, 1, 4)
+
             # create the audio panel
             self.audioPanel = QGroupBox("Propriétés de l'audio cible")
             gridAudioPanel = QGridLayout()
@@ -1050,6 +4658,8 @@ class RawWindow(QMainWindow):
                 self.outputFilename.setText(self.current.args.output.name)
                 self.missingBytes.setCurrentIndex(self.getIndexFromList(self.current.get_missing_bytes_method(), self.missingBytes_values))
                 self.conversion.setCurrentIndex(self.getIndexFromList(self.current.get_conversion_method(), self.conversion_values))
+                self.pixelLayout.setCurrentIndex(self.getIndexFromList(self.current.get_layout(), self.pixelLayout_values))
+                self.planar.setCurrentIndex(self.getIndexFromList(self.current.get_planar(), self.planar_values))
 
                 if self.current.is_image:
                     self.bitrate.setCurrentIndex(self.getIndexFromList(self.current.get_bitrate(), self.bitrate_values))
@@ -1058,6 +4668,8 @@ class RawWindow(QMainWindow):
                     self.mode.setCurrentIndex(self.getIndexFromList(self.current.get_pixel_mode(), self.mode_values))
                     self.sizeMode.setCurrentIndex(self.getIndexFromList(self.current.get_size_mode(), self.sizeMode_values))
                     self.update_sizeMode()
+                    self.update_widthCandidates()
+                    self.update_exactSizes()
             self.set_detailsText()
 
         def update_sizeMode(self):
@@ -1068,6 +4680,26 @@ class RawWindow(QMainWindow):
                 self.sizeValue.setText(str(self.current.get_ratio_size()).replace(".", ","))
                 self.sizeValue.setValidator(QDoubleValidator(0, 100, 4, self))
 
+        def update_widthCandidates(self):
+            self.widthCandidates.clear()
+            self.widthCandidates_values = [None] + self.current.get_width_candidates()
+            if len(self.widthCandidates_values) == 1:
+                self.widthCandidates.addItem("aucune périodicité détectée")
+            else:
+                self.widthCandidates.addItem("choisir...")
+            for c in self.widthCandidates_values[1:]:
+                self.widthCandidates.addItem("{} pixels (période de {:.1f} ms)".format(c[0], c[1]))
+
+        def update_exactSizes(self):
+            self.exactSizes.clear()
+            self.exactSizes_values = [None] + self.current.get_exact_sizes()
+            if len(self.exactSizes_values) == 1:
+                self.exactSizes.addItem("aucune taille exacte")
+            else:
+                self.exactSizes.addItem("choisir...")
+            for c in self.exactSizes_values[1:]:
+                self.exactSizes.addItem("{} par {} pixels".format(c[0], c[1]))
+
         def set_detailsText(self):
             if self.current != None:
                 sizes = self.current.get_size_info()
@@ -1111,6 +4743,17 @@ class RawWindow(QMainWindow):
             self.current.set_conversion_method(self.conversion_values[self.conversion.currentIndex()][0])
             self.set_detailsText()
 
+        @pyqtSlot()
+        def onUpdateLayout(self):
+            self.current.set_layout(self.pixelLayout_values[self.pixelLayout.currentIndex()][0])
+
+        @pyqtSlot()
+        def onUpdatePlanar(self):
+            self.current.set_planar(self.planar_values[self.planar.currentIndex()][0])
+            if not self.current.is_image:
+                self.update_exactSizes()
+            self.set_detailsText()
+
         @pyqtSlot()
         def onUpdateBitrate(self):
             self.current.set_bitrate(self.bitrate_values[self.bitrate.currentIndex()][0])
@@ -1124,6 +4767,8 @@ class RawWindow(QMainWindow):
         @pyqtSlot()
         def onUpdateMode(self):
             self.current.set_pixel_mode(self.mode_values[self.mode.currentIndex()][0])
+            self.update_widthCandidates()
+            self.update_exactSizes()
             self.set_detailsText()
 
         @pyqtSlot()
@@ -1132,12 +4777,32 @@ class RawWindow(QMainWindow):
             self.update_sizeMode()
             self.set_detailsText()
 
+        @pyqtSlot()
+        def onSelectWidthCandidate(self):
+            candidate = self.widthCandidates_values[self.widthCandidates.currentIndex()]
+            if candidate != None:
+                self.current.set_parameter("width", candidate[0])
+                self.updateUI()
+
+        @pyqtSlot()
+        def onSelectExactSize(self):
+            size = self.exactSizes_values[self.exactSizes.currentIndex()]
+            if size != None:
+                self.current.set_parameter("width", size[0])
+                self.updateUI()
+
         @pyqtSlot()
         def onUpdateSizeValue(self):
-            if self.current.get_size_mode() == "width":
-                self.current.set_width_value(self.sizeValue.text())
-            else:
-                self.current.set_ratio_value(self.sizeValue.text())
+            self.sizeValueTimer.stop()
+            try:
+                if self.current.get_size_mode() == "width":
+                    self.current.set_width_value(self.sizeValue.text())
+                else:
+                    self.current.set_ratio_value(self.sizeValue.text())
+            except ValueError:
+                # incomplete value
+                return
+            self.update_exactSizes()
             self.set_detailsText()
 
     def __init__(self, args, parent = None):
@@ -1148,6 +4813,14 @@ class RawWindow(QMainWindow):
 
         self.args = args
 
+        # the parameters copied to all the inputs are applied in a single pass, after a
+        # short delay (the sizes are only computed when displayed)
+        self.pending_parameters = {}
+        self.parameterTimer = QTimer(self)
+        self.parameterTimer.setSingleShot(True)
+        self.parameterTimer.setInterval(150)
+        self.parameterTimer.timeout.connect(self.apply_pending_parameters)
+
         bar = self.menuBar()
         file = bar.addMenu("Fichier")
         file.addAction("Ouvrir...").setShortcut(QKeySequence("Ctrl+O"))
@@ -1191,6 +4864,17 @@ class RawWindow(QMainWindow):
         self.hbox.addWidget(self.progressBar)
         self.progressBar.setVisible(False)
 
+        # progress of the current file, and cancellation of the conversions
+        self.itemProgressBar = QProgressBar()
+        self.hbox.addWidget(self.itemProgressBar)
+        self.itemProgressBar.setVisible(False)
+        self.cancelButton = QPushButton("Annuler")
+        self.hbox.addWidget(self.cancelButton)
+        self.cancelButton.setVisible(False)
+        self.cancelButton.clicked.connect(self.cancel_process)
+        self.progress = None
+        self.progress_time = 0
+
         self.setNbElements(0)
 
         self.inputs_widget.setFocus()
@@ -1242,12 +4926,30 @@ class RawWindow(QMainWindow):
 
     @pyqtSlot()
     def on_set_parameter_to_all(self, key, value, currentID):
+        # width and ratio are exclusive
+        for k in ["width", "ratio"] if key in ["width", "ratio"] else [key]:
+            self.pending_parameters.pop(k, None)
+        self.pending_parameters[key] = (value, currentID)
+        self.parameterTimer.start()
+
+    @pyqtSlot()
+    def apply_pending_parameters(self):
+        self.parameterTimer.stop()
+        if len(self.pending_parameters) == 0:
+            return
+        pending = self.pending_parameters
+        self.pending_parameters = {}
+
         inputs = self.inputs_widget.getInputs()
         nb = 0
         for input in inputs:
-            if input.id != currentID:
-                if input.set_parameter(key, value):
-                    nb += 1
+            modified = False
+            for key in pending:
+                value, currentID = pending[key]
+                if input.id != currentID and input.set_parameter(key, value):
+                    modified = True
+            if modified:
+                nb += 1
         if nb > 1:
             self.status_bar.showMessage("Réglage propagé à " + str(nb) + " entrées", 2000)
         elif nb == 1:
@@ -1257,6 +4959,7 @@ class RawWindow(QMainWindow):
     
     @pyqtSlot()
     def process_inputs(self):
+        self.apply_pending_parameters()
         inputs = self.inputs_widget.getInputs()
 
         # disable interface and draw a process bar
@@ -1264,48 +4967,110 @@ class RawWindow(QMainWindow):
         self.progressBar.setVisible(True)
         self.progressBar.setRange(0, len(inputs))
         self.progressBar.setValue(0)
+        self.itemProgressBar.setVisible(True)
+        self.cancelButton.setVisible(True)
         self.inputs_widget.setEnabled(False)
         self.edit_panel.setEnabled(False)
         self.invertConversion.setEnabled(False)
         
         error_dialog = QErrorMessage(self)
+        self.progress = Progress(self.update_item_progress)
+        cancelled = False
+        # the output directories may have changed since the names were proposed
+        RawWindow.output_names.refresh()
 
-        for i, input in enumerate(inputs):
-            self.progressBar.setValue(i + 1)
-            print(input.args)
-            print(input.args.output.name)
-            if input.file_properties_changed():
-                error_dialog.showMessage("Le fichier " + input.filename + " a changé de propriétés depuis son chargement, il sera ignoré")
-                self.status_bar.showMessage("Le fichier " + input.filename + " a changé depuis son chargement", 2000)
-            else:
-                self.status_bar.showMessage("Export vers " + input.args.output.name, 2000)
-                if input.is_image:
-                    print("Convert", input.filename, "to", input.args.output.name)
-                    Rawdodendron.save_as_audio(input.input_file, input.args, False)
-                else:
-                    print("Convert", input.filename, "to", input.args.output.name)
-                    Rawdodendron.save_as_image(input.input_file, input.args, False)
+        failures = 0
+        try:
+            for i, input in enumerate(inputs):
+                self.progressBar.setValue(i + 1)
+                print(input.args)
+                print(input.args.output.name)
+                if input.file_properties_changed():
+                    error_dialog.showMessage("Le fichier " + input.filename + " a changé de propriétés depuis son chargement, il sera ignoré")
+                    self.status_bar.showMessage("Le fichier " + input.filename + " a changé depuis son chargement", 2000)
+                    continue
+                input.args.progress = self.progress
+                try:
+                    input.reserve_output()
+                    self.status_bar.showMessage("Export vers " + input.args.output.name, 2000)
+                    if input.is_image:
+                        print("Convert", input.filename, "to", input.args.output.name)
+                        Rawdodendron.save_as_audio(input.input_file, input.args, False)
+                    else:
+                        print("Convert", input.filename, "to", input.args.output.name)
+                        Rawdodendron.save_as_image(input.input_file, input.args, False)
+                except Cancelled:
+                    # remove the reserved (or partial) output, and stop the conversions
+                    Rawdodendron.remove_outputs(input.args)
+                    cancelled = True
+                    break
+                except Exception as e:
+                    # remove the reserved (or partial) output, and continue with the next input
+                    print("Error while converting", input.filename, ":", e)
+                    Rawdodendron.remove_outputs(input.args)
+                    error_dialog.showMessage("Erreur lors de la conversion du fichier " + input.filename + " : " + str(e))
+                    failures += 1
+                    input.args.produced = None
+                    continue
+                finally:
+                    input.args.progress = None
                 # if required, inverse the conversion list
                 if self.invertConversion.isChecked():
                     input.inverse()
+                input.args.produced = None
                 # update output name in case of multiple runs
                 input.computeNextPossibleOutputName()
-        # set focus to the list after conversion
-        self.inputs_widget.setFocus()
-        # update list
-        if self.invertConversion.isChecked():
-            self.inputs_widget.updateWidgets()
-
-        # update panel
-        self.edit_panel.fullUpdateUI()
-
-        # update interface
-        self.inputs_widget.setEnabled(True)
-        self.edit_panel.setEnabled(True)
-        self.invertConversion.setEnabled(True)
-        self.processButton.setVisible(True)
-        self.progressBar.setVisible(False)
-        self.status_bar.showMessage("Conversions réalisées avec succès", 2000)
+        finally:
+            # restore the interface, even if an unexpected error occurred
+            self.progress = None
+            # set focus to the list after conversion
+            self.inputs_widget.setFocus()
+            # update list
+            if self.invertConversion.isChecked():
+                self.inputs_widget.updateWidgets()
+
+            # update panel
+            self.edit_panel.fullUpdateUI()
+
+            # update interface
+            self.inputs_widget.setEnabled(True)
+            self.edit_panel.setEnabled(True)
+            self.invertConversion.setEnabled(True)
+            self.processButton.setVisible(True)
+            self.progressBar.setVisible(False)
+            self.itemProgressBar.setVisible(False)
+            self.cancelButton.setVisible(False)
+        if cancelled:
+            self.status_bar.showMessage("Conversions annulées", 2000)
+        elif failures > 0:
+            self.status_bar.showMessage(str(failures) + " conversion(s) en erreur", 2000)
+        else:
+            self.status_bar.showMessage("Conversions réalisées avec succès", 2000)
+
+    # progress of the current file (see Progress). The events are processed during the
+    # conversion, to update the interface and to allow its cancellation
+    def update_item_progress(self, stage, done, total):
+        # the outputs may be encoded in other threads (see Rawdodendron.export_all)
+        if QThread.currentThread() != self.thread():
+            return
+        now = time.monotonic()
+        if now - self.progress_time < 0.05 and (total == None or done < total):
+            return
+        self.progress_time = now
+        names = {"decode": "Décodage", "convert": "Conversion", "encode": "Encodage"}
+        if total:
+            self.itemProgressBar.setRange(0, 1000)
+            self.itemProgressBar.setValue(min(1000, int(1000 * done / total)))
+            self.itemProgressBar.setFormat(names[stage] + " %p%")
+        else:
+            # unknown size (e.g. compressed output)
+            self.itemProgressBar.setRange(0, 0)
+            self.itemProgressBar.setFormat(names[stage])
+        QApplication.processEvents()
+
+    def cancel_process(self):
+        if self.progress != None:
+            self.progress.cancel()
 
 
     def setNbElements(self, nb = 0):
@@ -1349,9 +5114,21 @@ if __name__ == '__main__':
 
     # load and validate parameters
     args = parser.parse_args()
-
-
-    if args.input != None and args.output != None:
+    PCMCache.max_size = args.pcm_cache_size << 20
+    SegmentedDecoder.jobs = max(1, args.decode_jobs)
+    PNGWriter.jobs = max(1, args.png_jobs)
+
+
+    if args.probe != None:
+        # only print the conversion plan
+        Probe.run(args)
+    elif args.batch != None:
+        # convert a list of files
+        Rawdodendron.convert_batch(args)
+    elif args.manifest != None:
+        # convert the items of a manifest
+        Manifest.run(args)
+    elif args.input != None and args.output != None:
         # if input and output are provided, run the conversion
         Rawdodendron.convert(args)
     else: